@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+
+# (c) 2013, Tomasz Rybarczyk <paluho@gmail.com>
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Action plugin which coalesces consecutive augeas tasks into one module run.
+
+Coalescing is opt-in - it is enabled by `augeas_coalesce` variable. When
+a task is executed, following tasks from the same block are inspected.
+Every adjacent augeas task which can be safely executed together with
+the current one (no conditionals, loops, retries, failed_when, task vars,
+same shared options etc.) is added to the `batch` option of a single module
+invocation. Handlers are never coalesced. Per task
+results of the batch are stored on the controller (one pending batch per
+host) and returned when these tasks are executed later on (without running
+the module again). Pending batch is dropped as soon as any other augeas task
+is executed on the host.
+
+Changes of following tasks are saved before these tasks are executed, so
+tasks are never coalesced with `--step`, `any_errors_fatal` or
+`max_fail_percentage`.
+
+If the batch fails, only current task is executed and following tasks are
+executed as usual.
+"""
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import hashlib
+import json
+import os
+import re
+
+from ansible import constants as C
+from ansible import context
+from ansible.module_utils.parsing.convert_bool import boolean
+from ansible.playbook.handler import Handler
+from ansible.plugins.action import ActionBase
+
+
+# options which describe task commands - all other options have to be equal
+# in coalesced tasks
+TASK_OPTIONS = ['command', 'path', 'name', 'context', 'value', 'values', 'prune', 'commands',
+                'where', 'label', 'lens', 'file', 'filter', 'limit', 'offset', 'count_only', 'fields',
+                'format', 'depth', 'max_nodes']
+
+# task attributes which have to be equal in coalesced tasks
+TASK_ATTRIBUTES = ['become', 'become_user', 'become_method', 'check_mode', 'diff',
+                   'delegate_to', 'environment', 'ignore_errors', 'no_log', 'tags',
+                   'remote_user', 'connection', 'run_once', 'throttle', 'any_errors_fatal']
+
+
+class ActionModule(ActionBase):
+
+    def run(self, tmp=None, task_vars=None):
+        result = super(ActionModule, self).run(tmp, task_vars)
+        host = task_vars.get('inventory_hostname', '') if task_vars else ''
+
+        cached = self._pop_result(host, self._task)
+        if cached is not None:
+            result.update(cached)
+            return result
+
+        tasks = [self._task]
+        if boolean((task_vars or {}).get('augeas_coalesce', False), strict=False):
+            tasks += self._following_tasks()
+        if len(tasks) == 1:
+            result.update(self._execute_module(task_vars=task_vars))
+            return result
+
+        args = [self._task.args] + [self._templar.template(t.args) for t in tasks[1:]]
+        shared = self._shared_args(self._task.args)
+        # stop on first task which uses different shared options
+        for i, task_args in enumerate(args):
+            if self._shared_args(task_args) != shared:
+                tasks, args = tasks[:i], args[:i]
+                break
+
+        if len(tasks) > 1:
+            batch = [self._task_args(a) for a in args]
+            module_args = dict(shared, batch=batch)
+            batch_result = self._execute_module(module_args=module_args, task_vars=task_vars)
+            if not batch_result.get('failed') and 'batch' in batch_result:
+                self._store_batch(host, tasks[1:], batch_result['batch'][1:])
+                result.update(batch_result['batch'][0])
+                # results of whole run are returned with current task
+                for key in ('timings', 'warnings', 'deprecations'):
+                    if key in batch_result:
+                        result[key] = batch_result[key]
+                return result
+
+        # batch is not possible or failed - execute only current task
+        result.update(self._execute_module(task_vars=task_vars))
+        return result
+
+    def _shared_args(self, args):
+        return dict((k, v) for k, v in args.items() if k not in TASK_OPTIONS)
+
+    def _task_args(self, args):
+        args = dict((k, v) for k, v in args.items() if k in TASK_OPTIONS)
+        # resolve `path` aliases
+        for alias in ('name', 'context'):
+            if alias in args:
+                args['path'] = args.pop(alias)
+        return args
+
+    def _following_tasks(self):
+        """Return adjacent augeas tasks which can be executed together with
+        current one"""
+        # handlers are executed only when notified and current task can be
+        # executed many times or fail after it has applied following tasks
+        if isinstance(self._task, Handler) or not self._single_run(self._task):
+            return []
+        # following tasks are applied before they are executed, so they
+        # can't be skipped by user or stopped by failures of other hosts
+        if context.CLIARGS.get('step') or self._task.any_errors_fatal:
+            return []
+        play = getattr(self._task._parent, '_play', None)
+        if getattr(play, 'max_fail_percentage', None) is not None:
+            return []
+        parent = self._task._parent
+        siblings = getattr(parent, 'block', None) or []
+        uuids = [t._uuid for t in siblings]
+        if self._task._uuid not in uuids:
+            return []
+        registered = [self._task.register] if self._task.register else []
+        following = []
+        for task in siblings[uuids.index(self._task._uuid) + 1:]:
+            if not self._can_coalesce(task, registered):
+                break
+            following.append(task)
+            if task.register:
+                registered.append(task.register)
+        return following
+
+    def _can_coalesce(self, task, registered):
+        if getattr(task, 'action', None) != self._task.action:
+            return False
+        if task.when or task.vars or not self._single_run(task):
+            return False
+        for attribute in TASK_ATTRIBUTES:
+            if getattr(task, attribute, None) != getattr(self._task, attribute, None):
+                return False
+        # arguments can't depend on results of previous tasks from the batch
+        raw_args = json.dumps(task.args, default=str)
+        if any(re.search(r'\b%s\b' % re.escape(r), raw_args) for r in registered):
+            return False
+        return True
+
+    def _single_run(self, task):
+        """Whether task is executed once and its result can't fail it"""
+        return not any(getattr(task, attribute, None)
+                       for attribute in ('loop', 'loop_with', 'until', 'failed_when'))
+
+    def _batch_path(self, host):
+        key = hashlib.sha1(host.encode('utf-8')).hexdigest()
+        # local tmp directory is created per ansible run and removed on exit
+        return os.path.join(C.DEFAULT_LOCAL_TMP, 'augeas-batch-%s.json' % key)
+
+    def _store_batch(self, host, tasks, tasks_results):
+        with open(self._batch_path(host), 'w') as f:
+            json.dump({'tasks': [t._uuid for t in tasks], 'results': tasks_results}, f)
+
+    def _pop_result(self, host, task):
+        """Return stored result of the task when it is the next pending task
+        of the host batch - any other task drops the whole batch"""
+        path = self._batch_path(host)
+        try:
+            with open(path) as f:
+                batch = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if not batch['tasks'] or batch['tasks'][0] != task._uuid:
+            os.unlink(path)
+            return None
+        task_result = batch['results'].pop(0)
+        batch['tasks'].pop(0)
+        if batch['tasks']:
+            with open(path, 'w') as f:
+                json.dump(batch, f)
+        else:
+            os.unlink(path)
+        return task_result
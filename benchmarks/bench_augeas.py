@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks of augeas module with synthetic large config files.
+
+Fixture root (big /etc/hosts, sudoers, sshd_config and interfaces files) is
+generated locally and every scenario is executed in a separate process
+against fresh copy of it (through `root` option), so no remote host is
+required. Results (durations in seconds and peak RSS in kilobytes) are
+written as JSON:
+
+    python benchmarks/bench_augeas.py --output bench_output.json
+    python benchmarks/bench_augeas.py --scale 0.1 --scenario hosts_match
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+MODULE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'library', 'augeas.py')
+
+
+def load_module():
+    # module file is named like python-augeas package, so it has to be
+    # loaded under different name
+    try:
+        import importlib.util
+        spec = importlib.util.spec_from_file_location('ansible_augeas', MODULE_PATH)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+    except ImportError:
+        import imp
+        return imp.load_source('ansible_augeas', MODULE_PATH)
+
+
+def write(root, path, lines):
+    path = os.path.join(root, path.lstrip('/'))
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def generate_fixtures(root, scale):
+    hosts = int(100000 * scale)
+    write(root, '/etc/hosts',
+          ['127.0.0.1 localhost'] +
+          ['10.%d.%d.%d host%d.example.com host%d' % (i // 65536 % 256, i // 256 % 256, i % 256, i, i)
+           for i in range(hosts)])
+    specs = int(5000 * scale)
+    write(root, '/etc/sudoers',
+          ['Defaults env_reset', 'root ALL=(ALL) ALL'] +
+          ['user%d ALL=(ALL) NOPASSWD: /usr/bin/command%d' % (i, i) for i in range(specs)])
+    users = int(5000 * scale)
+    write(root, '/etc/ssh/sshd_config',
+          ['Port 22', 'PermitRootLogin no', 'PasswordAuthentication no'] +
+          ['AllowUsers %s' % ' '.join('user%d' % j for j in range(i, min(i + 100, users)))
+           for i in range(0, users, 100)])
+    ifaces = int(500 * scale)
+    lines = ['auto lo', 'iface lo inet loopback']
+    for i in range(ifaces):
+        lines += ['auto eth%d' % i, 'iface eth%d inet static' % i,
+                  '    address 10.1.%d.%d' % (i // 256, i % 256), '    netmask 255.255.0.0']
+    write(root, '/etc/network/interfaces', lines)
+    return {'hosts': hosts, 'sudoers_specs': specs, 'sshd_allow_users': users, 'interfaces': ifaces}
+
+
+def scenarios(sizes):
+    """Scenario name -> (autoload files or None for full autoload, engine,
+    commands, check). Check is called with (results, changed) and returns
+    True when scenario did what it is supposed to measure."""
+    hosts_set = '\n'.join('set /files/etc/hosts/%d/canonical host%d.example.org' % (i, i)
+                          for i in range(2, min(sizes['hosts'], 5000) + 2))
+    # structured commands - quotes inside predicates don't survive shlex
+    # without escaping
+    return {
+        'startup': ([], 'api', [], lambda results, changed: not changed),
+        'full_load': (None, 'api', [], lambda results, changed: not changed),
+        'hosts_match': (['/etc/hosts'], 'api', 'match /files/etc/hosts/*/canonical',
+                        lambda results, changed: len(results[0][1]) == sizes['hosts'] + 1),
+        'hosts_count': (['/etc/hosts'], 'api', [{'match': {'path': '/files/etc/hosts/*', 'count_only': True}}],
+                        lambda results, changed: results[0][1] == sizes['hosts'] + 1),
+        'hosts_export': (['/etc/hosts'], 'api', 'export /files/etc/hosts',
+                         lambda results, changed: len(results[0][1]['tree'][0]['children']) == sizes['hosts'] + 1),
+        'hosts_bulk_set': (['/etc/hosts'], 'api', hosts_set,
+                           lambda results, changed: changed and all(r for c, r in results)),
+        'hosts_bulk_set_srun': (['/etc/hosts'], 'srun', hosts_set, lambda results, changed: changed),
+        'sudoers_match': (['/etc/sudoers'], 'api', 'match /files/etc/sudoers/spec/user',
+                          lambda results, changed: len(results[0][1]) == sizes['sudoers_specs'] + 1),
+        'sudoers_set': (['/etc/sudoers'], 'api',
+                        [{'set': {'path': '/files/etc/sudoers/spec[user="user1"]/host_group/command/tag',
+                                  'value': 'PASSWD'}}],
+                        lambda results, changed: changed and results[0][1] is True),
+        'sshd_append_unique': (['/etc/ssh/sshd_config'], 'api',
+                               'append-unique /files/etc/ssh/sshd_config/AllowUsers/* newuser',
+                               lambda results, changed: changed and results[0][1] is True),
+        'interfaces_defnode': (['/etc/network/interfaces'], 'api',
+                               [{'defnode': {'name': 'iface', 'value': 'eth1',
+                                             'expr': '/files/etc/network/interfaces/iface[.="eth1"]'}},
+                                {'set': {'path': '$iface/address', 'value': '10.2.0.1'}},
+                                {'set': {'path': '$iface/netmask', 'value': '255.255.255.0'}}],
+                               # defnode reports False when the node already exists
+                               lambda results, changed: changed and [r for c, r in results] == [False, True, True]),
+    }
+
+
+def run_scenario(queue, fixtures, loadpath, sizes, name):
+    # checks can't be pickled, so scenario is looked up in the child process
+    files, engine, script, check = scenarios(sizes)[name]
+    root = tempfile.mkdtemp(prefix='augeas-bench-')
+    try:
+        root_copy = os.path.join(root, 'root')
+        shutil.copytree(fixtures, root_copy)
+        started = time.time()
+        module = load_module()
+        import_time = time.time() - started
+        commands = module.parse_commands(script) if script else []
+        timings = {}
+        augeas_instance = module.open_augeas(root_copy, loadpath, 0, set(files) if files is not None else None,
+                                             timings)
+        results, changed = module.execute(augeas_instance, commands, engine=engine, timings=timings)
+        module.profile_summary(augeas_instance, timings)
+        timings['import'] = import_time
+        timings['commands_total'] = sum(c['time'] for c in timings.pop('commands'))
+        timings['nodes'] = sum(timings['nodes'].values())
+        timings['wall'] = time.time() - started
+        timings['changed'] = changed
+        if not check(results, changed):
+            timings = {'error': 'unexpected results (changed=%s): %.500s' % (changed, results)}
+        queue.put(timings)
+    except Exception as e:
+        queue.put({'error': '%s: %s' % (type(e).__name__, e)})
+    finally:
+        shutil.rmtree(root)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--scale', type=float, default=1.0, help='fixtures size multiplier')
+    parser.add_argument('--scenario', action='append', help='run only given scenarios')
+    parser.add_argument('--loadpath', default=None, help='augeas lenses loadpath')
+    parser.add_argument('--output', default=None, help='JSON report path (stdout by default)')
+    args = parser.parse_args()
+
+    fixtures = tempfile.mkdtemp(prefix='augeas-fixtures-')
+    try:
+        sizes = generate_fixtures(fixtures, args.scale)
+        report = {'sizes': sizes, 'scale': args.scale, 'python': sys.version.split()[0], 'scenarios': {}}
+        for name in sorted(scenarios(sizes)):
+            if args.scenario and name not in args.scenario:
+                continue
+            # fresh process per scenario, so peak RSS isn't shared
+            queue = multiprocessing.Queue()
+            process = multiprocessing.Process(target=run_scenario,
+                                              args=(queue, fixtures, args.loadpath, sizes, name))
+            process.start()
+            report['scenarios'][name] = queue.get()
+            process.join()
+            sys.stderr.write('%s: %s\n' % (name, json.dumps(report['scenarios'][name], sort_keys=True)))
+            # timings of scenario which didn't do its job are meaningless
+            if 'error' in report['scenarios'][name]:
+                sys.exit('scenario %s failed: %s' % (name, report['scenarios'][name]['error']))
+        report['peak_rss_parent'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    finally:
+        shutil.rmtree(fixtures)
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        sys.stdout.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
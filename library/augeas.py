@@ -33,9 +33,9 @@ requirements:
 options:
   command:
     required: false
-    choices: [ set, ins, rm, match ]
+    choices: [ set, ins, rm, match, span, ensure_tree, set-if-missing, append-unique, rm-if-value, export, transform, load ]
     description:
-      - Whether given path should be modified, inserted, removed or matched. Command "match" passes results through "result" attribute - every item on this list is an object with "label" and "value" (check third example below). Other commands returns true in case of any modification (so this value is always equal to "changed" attribue - this make more sens in case of bulk execution)
+      - Whether given path should be modified, inserted, removed or matched. Command "match" passes results through "result" attribute - every item on this list is an object with "label" and "value" (check third example below). Command "ensure_tree" sets all "values" (relative path -> value mapping) beneath "path" reading existing subtree only once and optionally ("prune") removes all other nodes. Command "span" works like "match" but every item contains additionally "file" and byte offsets of node in this file ("label_start", "label_end", "value_start", "value_end", "span_start", "span_end"). Command "export" returns nodes matched by "path" with their subtrees as nested {"label", "value", "children"} objects (see "depth" and "max_nodes"). Other commands returns true in case of any modification (so this value is always equal to "changed" attribue - this make more sens in case of bulk execution)
   path:
     required: false
     description:
@@ -44,6 +44,49 @@ options:
     required: false
     description:
       - Variable value (required for "set" command)
+  values:
+    required: false
+    description:
+      - Mapping of relative paths to values (required for "ensure_tree" command)
+  prune:
+    required: false
+    default: "no"
+    choices: [ "yes", "no" ]
+    description:
+      - Remove nodes beneath "ensure_tree" path which are not listed in "values" (comments are kept)
+  limit:
+    required: false
+    description:
+      - Return at most this number of "match" results
+  offset:
+    required: false
+    description:
+      - Skip this number of "match" results
+  count_only:
+    required: false
+    default: "no"
+    choices: [ "yes", "no" ]
+    description:
+      - Return only number of nodes matched by "match" command
+  fields:
+    required: false
+    default: [ label, value ]
+    description:
+      - Fields returned by "match" command - values are not fetched at all when "value" is not listed
+  format:
+    required: false
+    default: rows
+    choices: [ rows, columns ]
+    description:
+      - Format of "match" results - list of {"label", "value"} objects ("rows") or object with parallel "labels" and "values" lists ("columns")
+  depth:
+    required: false
+    description:
+      - Maximum depth of "export" subtrees - 0 exports only matched nodes, 1 also their children etc. (unlimited by default)
+  max_nodes:
+    required: false
+    description:
+      - Maximum number of nodes returned by "export" - walk is stopped and result is marked as "truncated" when it is exceeded
   label:
     required: false
     description:
@@ -61,10 +104,18 @@ options:
     required: false
     description:
       - File to parse
+  files:
+    required: false
+    description:
+      - Glob pattern (relative to "root") of files which should be modified with the same commands. Requires "lens" - paths are relative within every file (like with "file" option). Every file is handled in separate process with its own single file augeas instance ("worker", "cache_dir" and "autoload" can't be used). Result always contains list of (command, command result) tuples of all files
+  forks:
+    required: false
+    description:
+      - Number of processes used with "files" option (defaults to number of CPUs, never more than number of matched files)
   commands:
     required: false
     description:
-      - Execute many commands at once (some configuration entries have to be created/updated at once - it is impossible to split them across multiple "set" calls). Standard shell quoting is allowed (rember to escape all quotes inside pahts/values - check last example). Expected formats: "set path value", "rm path" or "match path" (look into examples for more details). You can separate commands with any white chars (new lines, spaces etc.). Result is passed through "result" attribute and contains list of tuples: (command, command result)
+      - Execute many commands at once (some configuration entries have to be created/updated at once - it is impossible to split them across multiple "set" calls). Standard shell quoting is allowed (rember to escape all quotes inside pahts/values - check last example). Expected formats: "set path value", "rm path", "match path", "defvar name expr", "defnode name expr value", "set-if-missing path value" (set only when path doesn't match anything), "append-unique path value" (append value to list unless it's already there) or "rm-if-value path value" (remove matched nodes with given value) (look into examples for more details). Variables defined by "defvar" and "defnode" can be used in following paths as "$name" - the expression is evaluated only once. You can separate commands with any white chars (new lines, spaces etc.). Commands can be also given as a list of single key dicts (command name -> parameters dict, e.g. "- set: {path: ..., value: ...}") - no quoting is required then. Result is passed through "result" attribute and contains list of tuples: (command, command result)
   root:
     required: false
     description:
@@ -73,9 +124,84 @@ options:
     required: false
     description:
       - Colon-spearated list of directories that modules should be searched in
+  autoload:
+    required: false
+    default: all
+    choices: [ all, selective ]
+    description:
+      - With "all" augeas autoloads every lens and parses every file which is matched by any of them. With "selective" the module extracts files from "/files/..." paths of given commands, restricts autoloaded transforms to these files and parses only them. When any path can't be mapped to an existing file (for example it contains wildcards or predicates before file name) the module fallbacks to "all"
+  engine:
+    required: false
+    default: api
+    choices: [ api, srun ]
+    description:
+      - How commands are executed. With "api" every command is executed through python bindings. With "srun" consecutive "set", "rm" and "ins" commands are passed to libaugeas "aug_srun" as a single script (other commands and commands with new lines or backslashes in arguments still go through python bindings). In "srun" mode result of these commands tells whether file touched by the command was saved ("api" is always used for coalesced tasks - see "batch")
+  span:
+    required: false
+    default: "no"
+    choices: [ "yes", "no" ]
+    description:
+      - Track span (position in file) of every loaded node. It increases memory usage, so it is disabled by default. It is enabled automatically when "span" command is used
+  worker:
+    required: false
+    default: "no"
+    choices: [ "yes", "no" ]
+    description:
+      - Execute commands in a long living worker process (started on first use) which keeps parsed trees between module invocations. Before every request worker reloads only files which were modified (mtime or size changed). Variables defined by "defvar" and "defnode" are not kept between requests and trees of requests with "transform" or "load" commands are not reused. Trees are parsed again when lenses are modified and worker exits when it was started by different version of the module. If the worker can't be reached, commands are executed by the module itself
+  worker_socket:
+    required: false
+    default: ~/.ansible/tmp/augeas-worker.sock
+    description:
+      - Unix socket path of the worker
+  worker_timeout:
+    required: false
+    default: 300
+    description:
+      - Number of seconds after which idle worker exits
+  cache_dir:
+    required: false
+    description:
+      - Directory of read only runs results cache. Results of commands scripts which contain only "match" (and "defvar") commands with paths resolvable to existing files are cached and augeas is not initialized at all on cache hit. Cache entries are invalidated when mtime, size or inode of any of these files changes or when lenses (in "loadpath" and augeas lens directories) are modified
+  cache_size:
+    required: false
+    default: 10485760
+    description:
+      - Maximum total size (in bytes) of cache entries - least recently used entries are removed
+  profile:
+    required: false
+    default: "no"
+    choices: [ "yes", "no" ]
+    description:
+      - Return "timings" object with durations (in seconds) of augeas initialization ("init"), files loading ("load", "load_files"), every command ("commands"), "save" and errors collection ("errors"), nodes count of every loaded file ("nodes") and peak RSS in kilobytes ("peak_rss"). Timings are not collected when results come from "worker", "cache_dir" or "files" execution
+  profile_dump:
+    required: false
+    description:
+      - Path (on managed host) where cProfile stats of augeas initialization and commands execution are dumped
+  global_errors:
+    required: false
+    default: "no"
+    choices: [ "yes", "no" ]
+    description:
+      - On failure report errors of all loaded files ("/augeas//error") instead of only errors of files touched by failing command ("/augeas/files<file>//error")
+  lock:
+    required: false
+    default: "no"
+    choices: [ "yes", "no" ]
+    description:
+      - Take advisory locks of files which are going to be modified (whole "root" when they can't be determined from command paths) before they are loaded and release them after save, so concurrent runs against the same files don't overwrite each other changes
+  lock_dir:
+    required: false
+    default: ~/.ansible/tmp/augeas-locks
+    description:
+      - Directory of lock files used by "lock" option
+  batch:
+    required: false
+    description:
+      - List of task options dicts ("command", "path", "value", "label", "where", "lens", "file", "filter" or "commands") which are executed in one augeas session. Results are returned through "batch" attribute - one {"changed", "result"} object per task. This option is used by "augeas" action plugin which coalesces consecutive augeas tasks
 notes:
    - On Debian Wheezy you also need to install libpython2.7, since python-augeas package wrongly does not list it as a requirement
    - When using lens & file, path is relative within the file and is concatenated by the module. This means that file="/mnt/etc/sshd_config" path="AllowUsers/*" is transformed into augeas '/files//mnt/etc/sshd_config/AllowUsers/*' path
+   - Check mode is supported - changes are saved in augeas "noop" save mode, all failing commands are reported at once and with diff mode before/after content of files which would be changed is returned (requires bindings with "text_retrieve")
 '''
 
 EXAMPLES = '''
@@ -88,15 +214,41 @@ EXAMPLES = '''
 - augeas: command="set" path="/files/etc/ssh/sshd_config/AllowUsers/01" value="{{ user }}"
   when: "user_entry.result|length == 0"
 
+# The same in a single run - append value only if it doesn't exists already in config
+- augeas: command="append-unique" path="/files/etc/ssh/sshd_config/AllowUsers/*" value="{{ user }}"
+
+# Count entries of big file
+- augeas: command=match path="/files/etc/hosts/*" count_only=yes
+
+# Fetch second page of values only
+- augeas: command=match path="/files/etc/hosts/*/canonical" offset=100 limit=100 fields=value format=columns
+
 # Modify sshd_config in custom location
 - augeas: commands="match" lens="sshd" file="/home/paluh/programming/ansible/tests/sshd_config" path="AllowUsers/*"
 
+# Apply the same edit to every enabled nginx site (files are processed in parallel)
+- augeas: lens=nginx files=/etc/nginx/sites-enabled/* commands="set server/server_tokens off"
+
 # Add new host to /etc/hosts (bulk command execution)
 - augeas: commands='set /files/etc/hosts/01/ipaddr 192.168.0.1
                     set /files/etc/hosts/01/canonical pigiron.example.com
                     set /files/etc/hosts/01/alias[1] pigiron
                     set /files/etc/hosts/01/alias[2] piggy'
 
+# Declarative management of whole sshd_config section
+- augeas: command=ensure_tree path=/files/etc/ssh/sshd_config prune=no
+  args:
+    values:
+      PermitRootLogin: 'no'
+      PasswordAuthentication: 'no'
+      AllowUsers/1: paluh
+
+# Commands as a list of dicts (no shell quoting required)
+- augeas:
+    commands:
+      - set: {path: '/files/etc/hosts/01/ipaddr', value: '192.168.0.1'}
+      - set: {path: '/files/etc/hosts/01/canonical', value: 'pigiron.example.com'}
+
 # Redefine eth0 interface (augeas requires quotes in path matching expressions: iface[.=\\"eth0\\"])
 - augeas: commands='rm /files/etc/network/interfaces/iface[.=\\"eth0\\"]
                     set /files/etc/network/interfaces/iface[last()+1] eth0
@@ -104,64 +256,101 @@ EXAMPLES = '''
                     set /files/etc/network/interfaces/iface[.=\\"eth0\\"]/method manual
                     set /files/etc/network/interfaces/iface[.=\\"eth0\\"]/pre-up "ifconfig $IFACE up"
                     set /files/etc/network/interfaces/iface[.=\\"eth0\\"]/pre-down "ifconfig $IFACE down"'
+
+# The same with "defnode" - predicate is evaluated only once
+- augeas: commands='rm /files/etc/network/interfaces/iface[.=\\"eth0\\"]
+                    defnode iface /files/etc/network/interfaces/iface[.=\\"eth0\\"] eth0
+                    set $iface/family inet
+                    set $iface/method manual'
 '''
 
 try:
     import augeas
 except ImportError:
     augeas = None
+try:
+    basestring
+except NameError:
+    # python 3
+    basestring = unicode = str
 from collections import namedtuple
+import cProfile
 import ctypes
+import ctypes.util
+import fcntl
+import fnmatch
+import glob
+import hashlib
+import inspect
+import json
+import multiprocessing
+import os
 import re
+import resource
 import shlex
+import socket
 import operator
+import sys
+import tempfile
+import time
 
 if augeas:
     # Augeas C API `aug_span` function was introduced on the begining of 2011
     # but python-augeas 0.4 was released month before and doesn't contain bindings for it
     # This code is copied from current devel branch of python-augeas
+    class Augeas(augeas.Augeas):
+
+        # libaugeas versions without span support just ignore this flag
+        ENABLE_SPAN = getattr(augeas.Augeas, 'ENABLE_SPAN', 128)
 
-    # check whether augeas library supports span
-    if augeas.Augeas(flags=getattr(augeas.Augeas, 'NO_MODL_AUTOLOAD', 0)).match('/augeas/span'):
         if not hasattr(augeas.Augeas, 'span'):
-            class Augeas(augeas.Augeas):
-
-                ENABLE_SPAN = 128
-
-                def span(self, path):
-                    """Get the span according to input file of the node associated with
-                    PATH. If the node is associated with a file, un tuple of 5 elements is
-                    returned: (filename, label_start, label_end, value_start, value_end,
-                    span_start, span_end). If the node associated with PATH doesn't
-                    belong to a file or is doesn't exists, ValueError is raised."""
-
-                    if not isinstance(path, basestring):
-                        raise TypeError("path MUST be a string!")
-                    if not self.__handle:
-                        raise RuntimeError("The Augeas object has already been closed!")
-
-                    filename = ctypes.c_char_p()
-                    label_start = ctypes.c_uint()
-                    label_end = ctypes.c_uint()
-                    value_start = ctypes.c_uint()
-                    value_end = ctypes.c_uint()
-                    span_start = ctypes.c_uint()
-                    span_end = ctypes.c_uint()
-
-                    r = ctypes.byref
-
-                    ret = Augeas._libaugeas.aug_span(self.__handle, path, r(filename),
-                                                     r(label_start), r(label_end),
-                                                     r(value_start), r(value_end),
-                                                     r(span_start), r(span_end))
-                    if ret < 0:
-                        raise ValueError("Error during span procedure")
-
-                    return (filename.value, label_start.value, label_end.value,
-                            value_start.value, value_end.value,
-                            span_start.value, span_end.value)
-        else:
-            Augeas = augeas.Augeas
+            def span(self, path):
+                """Get the span according to input file of the node associated with
+                PATH. If the node is associated with a file, un tuple of 5 elements is
+                returned: (filename, label_start, label_end, value_start, value_end,
+                span_start, span_end). If the node associated with PATH doesn't
+                belong to a file or is doesn't exists, ValueError is raised."""
+
+                if not isinstance(path, basestring):
+                    raise TypeError("path MUST be a string!")
+                if not self.__handle:
+                    raise RuntimeError("The Augeas object has already been closed!")
+                if not span_supported(self):
+                    raise ValueError("Augeas library doesn't support span")
+
+                filename = ctypes.c_char_p()
+                label_start = ctypes.c_uint()
+                label_end = ctypes.c_uint()
+                value_start = ctypes.c_uint()
+                value_end = ctypes.c_uint()
+                span_start = ctypes.c_uint()
+                span_end = ctypes.c_uint()
+
+                r = ctypes.byref
+
+                ret = Augeas._libaugeas.aug_span(self.__handle, path, r(filename),
+                                                 r(label_start), r(label_end),
+                                                 r(value_start), r(value_end),
+                                                 r(span_start), r(span_end))
+                if ret < 0:
+                    raise ValueError("Error during span procedure")
+
+                return (filename.value, label_start.value, label_end.value,
+                        value_start.value, value_end.value,
+                        span_start.value, span_end.value)
+
+
+# span support detection results memoized per libaugeas version
+SPAN_SUPPORT = {}
+
+
+def span_supported(augeas_instance):
+    """Check on live instance whether underlying libaugeas supports span
+    (`/augeas/span` node is present only in these versions)"""
+    version = augeas_instance.get('/augeas/version')
+    if version not in SPAN_SUPPORT:
+        SPAN_SUPPORT[version] = bool(augeas_instance.match('/augeas/span'))
+    return SPAN_SUPPORT[version]
 
 
 class CommandsParseError(Exception):
@@ -171,7 +360,7 @@ class CommandsParseError(Exception):
         super(CommandsParseError, self).__init__(msg)
 
     def format_commands(self, commands):
-        return '\n'.join('%s %s' % (c, ' '.join(a if a else "''" for a in args.values())) for c, args in commands)
+        return '\n'.join(format_command(c, args, "''") for c, args in commands)
 
 
 class MissingArgument(CommandsParseError):
@@ -250,6 +439,119 @@ class OneOfParser(RegexParser):
         return super(OneOfParser, cls).__new__(cls, name, '(%s)' % '|'.join(patterns))
 
 
+class BooleanParser(ParamParser):
+
+    TRUE = ['yes', 'on', 'true', '1']
+    FALSE = ['no', 'off', 'false', '0']
+
+    def __new__(cls, name):
+        return super(BooleanParser, cls).__new__(cls, name, None)
+
+    def __call__(self, value):
+        if value is None:
+            return False
+        if isinstance(value, bool):
+            return value
+        if isinstance(value, basestring) and value.lower() in self.TRUE + self.FALSE:
+            return value.lower() in self.TRUE
+        raise ParamParseError(self.name, value, 'boolean')
+
+
+class MappingParser(ParamParser):
+    """Relative path -> value mapping given as dict or JSON object string"""
+
+    def __new__(cls, name):
+        return super(MappingParser, cls).__new__(cls, name, None)
+
+    def __call__(self, value):
+        if isinstance(value, basestring):
+            try:
+                value = json.loads(value)
+            except ValueError:
+                raise ParamParseError(self.name, value, 'JSON object')
+        if not isinstance(value, dict):
+            raise ParamParseError(self.name, value, 'mapping')
+        mapping = {}
+        for path, v in value.items():
+            if isinstance(v, (int, float)) and not isinstance(v, bool):
+                v = str(v)
+            if not isinstance(path, basestring) or not path or not (v is None or isinstance(v, basestring)):
+                raise ParamParseError(self.name, {path: v}, 'mapping of paths to strings '
+                                      '(remember to quote yes/no values in yaml)')
+            mapping[path] = v
+        return mapping
+
+
+class IntegerParser(ParamParser):
+    """Non negative integer (`None` when missing)"""
+
+    def __new__(cls, name):
+        return super(IntegerParser, cls).__new__(cls, name, re.compile(r'^\d+$'))
+
+    def __call__(self, value):
+        if value is None or (isinstance(value, int) and not isinstance(value, bool) and value >= 0):
+            return value
+        if isinstance(value, basestring) and self.validator.match(value):
+            return int(value)
+        raise ParamParseError(self.name, value, 'non negative integer')
+
+
+class ChoicesParser(ParamParser):
+    """One or many (comma separated string or list) of given choices - first
+    choice is the default"""
+
+    def __new__(cls, name, choices, many=False):
+        parser = super(ChoicesParser, cls).__new__(cls, name, choices)
+        parser.many = many
+        return parser
+
+    def __call__(self, value):
+        if value is None:
+            return list(self.validator) if self.many else self.validator[0]
+        values = value.split(',') if isinstance(value, basestring) else value
+        if not self.many:
+            values = [values]
+        if not isinstance(values, list) or not values or any(v not in self.validator for v in values):
+            raise ParamParseError(self.name, value, '%s of: %s' % ('list' if self.many else 'one',
+                                                                   ', '.join(self.validator)))
+        return values if self.many else values[0]
+
+
+def format_param(param, empty='""'):
+    if isinstance(param, basestring):
+        return param if param else empty
+    return json.dumps(param, sort_keys=True)
+
+
+# validators are shared by all parsed commands
+PATH_PARSER = NonEmptyParser('path')
+COMMANDS = {
+    'set': [PATH_PARSER, AnythingParser('value')],
+    'rm': [PATH_PARSER],
+    'match': [PATH_PARSER],
+    'span': [PATH_PARSER],
+    'ins': [NonEmptyParser('label'), OneOfParser('where', ['before', 'after']), PATH_PARSER],
+    'transform': [NonEmptyParser('lens'), OneOfParser('filter', ['incl', 'excl']), NonEmptyParser('file')],
+    'load': [],
+    'ensure_tree': [PATH_PARSER, MappingParser('values')],
+    'defvar': [NonEmptyParser('name'), NonEmptyParser('expr')],
+    'defnode': [NonEmptyParser('name'), NonEmptyParser('expr'), AnythingParser('value')],
+    'set-if-missing': [PATH_PARSER, AnythingParser('value')],
+    'append-unique': [PATH_PARSER, AnythingParser('value')],
+    'rm-if-value': [PATH_PARSER, AnythingParser('value')],
+    'export': [PATH_PARSER]
+}
+
+# optional parameters - accepted only by structured commands and
+# module options (`None` is passed to parser when parameter is missing)
+COMMAND_OPTIONS = {
+    'ensure_tree': [BooleanParser('prune')],
+    'match': [IntegerParser('limit'), IntegerParser('offset'), BooleanParser('count_only'),
+              ChoicesParser('fields', ['label', 'value'], many=True), ChoicesParser('format', ['rows', 'columns'])],
+    'export': [IntegerParser('depth'), IntegerParser('max_nodes')]
+}
+
+
 def parse_commands(commands):
     """
     Basic tests (if you are going to modify this function update/check tests too
@@ -276,21 +578,21 @@ def parse_commands(commands):
     set /path ''
     >>> assert (parse_commands("ins alias before /path") == \
                 [('ins', {'path': '/path', 'where': 'before', 'label': 'alias'})])
+    >>> assert (parse_commands("ensure_tree /path '{\\"a/b\\": \\"c\\"}'") == \
+                [('ensure_tree', {'path': '/path', 'values': {'a/b': 'c'}, 'prune': False})])
+    >>> parse_commands("match /files/etc/hosts/* set /x")
+    Traceback (most recent call last):
+    ...
+    MissingArgument: Missing argument "value" in "set" statement - already parsed statements:
+    match /files/etc/hosts/*
     >>> parse_commands("ins alias bfore /path")
     Traceback (most recent call last):
     ...
     CommandsParseError: Error parsing parameter value of command "ins":
     Given 'where' value: 'bfore' doesn't match expected value: re.compile('(before|after)')
     """
-    path_parser = NonEmptyParser('path')
-    COMMANDS = {
-        'set': [path_parser, AnythingParser('value')],
-        'rm': [path_parser],
-        'match': [path_parser],
-        'ins': [NonEmptyParser('label'), OneOfParser('where', ['before', 'after']), path_parser],
-        'transform': [NonEmptyParser('lens'), OneOfParser('filter', ['incl', 'excl']), NonEmptyParser('file')],
-        'load': []
-    }
+    if isinstance(commands, list):
+        return parse_structured_commands(commands)
     try:
         tokens = iter(shlex.split(commands, comments=False))
     except ValueError as e:
@@ -305,15 +607,80 @@ def parse_commands(commands):
                 value = next(tokens)
             except StopIteration:
                 raise MissingArgument(command, parser.name, parsed)
-            try:
-                params[parser.name] = parser(value)
-            except ParamParseError as e:
-                raise CommandsParseError('Error parsing parameter value of command "%(command)s":\n%(exception)s' %
-                                         {'command': command, 'exception': e})
+            params[parser.name] = parse_param(command, parser, value)
+        for parser in COMMAND_OPTIONS.get(command, []):
+            params[parser.name] = parse_param(command, parser, None)
+        parsed.append((command, params))
+    return parsed
+
+
+def parse_structured_commands(commands):
+    """Parse list of single key dicts (command name -> params dict) - no
+    tokenization and quoting is required in this case:
+
+    >>> assert (parse_commands([{'set': {'path': '/path[.="pattern"]', 'value': 'value with spaces'}},
+    ...                         {'load': None}]) == \
+                [('set', {'path': '/path[.="pattern"]', 'value': 'value with spaces'}), ('load', {})])
+    >>> assert (parse_commands([{'set': {'path': '/path', 'value': 22}}]) == \
+                [('set', {'path': '/path', 'value': '22'})])
+    >>> parse_commands([{'set': {'path': '/path'}}])
+    Traceback (most recent call last):
+    ...
+    MissingArgument: Missing argument "value" in "set" statement
+    >>> parse_commands([{'set': {'path': '/path', 'value': True}}])
+    Traceback (most recent call last):
+    ...
+    CommandsParseError: Error parsing parameter value of command "set":
+    Given 'value' value: True should be a string (remember to quote yes/no values in yaml)
+    >>> assert (parse_commands([{'ensure_tree': {'path': '/path', 'values': {'a/b': 'c'}, 'prune': 'yes'}}]) == \
+                [('ensure_tree', {'path': '/path', 'values': {'a/b': 'c'}, 'prune': True})])
+    >>> parse_commands([{'rm': {'path': '/path', 'value': ''}}])
+    Traceback (most recent call last):
+    ...
+    CommandsParseError: Unknown parameters of "rm" command: value
+    """
+    parsed = []
+    for item in commands:
+        if not isinstance(item, dict) or len(item) != 1:
+            raise CommandsParseError('Every command should be a dict with single key (command name), got: %s' %
+                                     repr(item))
+        command, args = list(item.items())[0]
+        if command not in COMMANDS:
+            raise UnknownCommand(command, parsed)
+        args = args or {}
+        if not isinstance(args, dict):
+            raise CommandsParseError('Parameters of "%s" command should be a dict, got: %s' % (command, repr(args)))
+        options = COMMAND_OPTIONS.get(command, [])
+        unknown = set(args) - set(parser.name for parser in COMMANDS[command] + options)
+        if unknown:
+            raise CommandsParseError('Unknown parameters of "%s" command: %s' % (command, ', '.join(sorted(unknown))))
+        params = {}
+        for parser in COMMANDS[command]:
+            if parser.name not in args:
+                raise MissingArgument(command, parser.name, parsed)
+            value = args[parser.name]
+            # yaml parses unquoted yes/no as booleans - refuse them
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                value = str(value)
+            if isinstance(parser, RegexParser) and not isinstance(value, basestring):
+                raise CommandsParseError('Error parsing parameter value of command "%s":\n'
+                                         'Given %s value: %s should be a string (remember to quote '
+                                         'yes/no values in yaml)' % (command, repr(parser.name), repr(value)))
+            params[parser.name] = parse_param(command, parser, value)
+        for parser in options:
+            params[parser.name] = parse_param(command, parser, args.get(parser.name))
         parsed.append((command, params))
     return parsed
 
 
+def parse_param(command, parser, value):
+    try:
+        return parser(value)
+    except ParamParseError as e:
+        raise CommandsParseError('Error parsing parameter value of command "%(command)s":\n%(exception)s' %
+                                 {'command': command, 'exception': e})
+
+
 class ExceptionWithMessage(Exception):
 
     def __init__(self, msg, *args, **kwargs):
@@ -326,9 +693,25 @@ class AugeasError(ExceptionWithMessage):
     path = None
     error_type = None
 
-    def format_augeas_errors(self, augeas_instance):
+    # time spent on errors collection (reported by `profile` option)
+    errors_time = None
+
+    def format_augeas_errors(self, augeas_instance, files=None):
+        started = time.time()
+        try:
+            return self._format_augeas_errors(augeas_instance, files)
+        finally:
+            self.errors_time = time.time() - started
+
+    def _format_augeas_errors(self, augeas_instance, files=None):
+        """Report errors of given files (`/augeas/files<file>`) or all
+        errors from `/augeas` tree when files are not given"""
+        if files is None:
+            error_nodes = augeas_instance.match('/augeas//error')
+        else:
+            error_nodes = [e for f in files for e in augeas_instance.match('/augeas/files%s//error' % f)]
         errors = []
-        for error in augeas_instance.match('/augeas//error'):
+        for error in error_nodes:
             error_type = augeas_instance.get(error)
             if not self.error_type or not error_type or self.error_type == error_type:
                 errors.append([(p, augeas_instance.get(p)) for p in augeas_instance.match(error + '/' + '*')])
@@ -337,9 +720,13 @@ class AugeasError(ExceptionWithMessage):
             errors = '\n\n'.join('\n'.join('%s: %s'%(p, v) for p, v in error) for error in errors)
             return ('Augeas has reported following problems '
                     ' (it\'s possible that some of them are unrelated to your action):\n\n%s' % errors)
+        hint = ''
+        if files is not None:
+            hint = (' (only errors of %s were checked - use "global_errors" option to check all loaded files)' %
+                    ', '.join(files))
         if self.error_type is not None:
-            return 'Augeas hasn\'t provided any additional info for action type (%s)' % self.error_type
-        return 'Augeas hasn\'t provided any additional info'
+            return 'Augeas hasn\'t provided any additional info for action type (%s)%s' % (self.error_type, hint)
+        return 'Augeas hasn\'t provided any additional info%s' % hint
 
 
 class PathParseError(AugeasError):
@@ -353,19 +740,81 @@ class PathParseError(AugeasError):
 
 class SaveError(AugeasError):
 
-    def __init__(self, augeas_instance):
-        msg = 'Augeas refused to save changes. %s' % self.format_augeas_errors(augeas_instance)
+    def __init__(self, augeas_instance, files=None):
+        msg = 'Augeas refused to save changes. %s' % self.format_augeas_errors(augeas_instance, files)
         super(SaveError, self).__init__(msg)
 
 
 class CommandError(AugeasError):
 
-    def __init__(self, command, params, augeas_instance):
+    def __init__(self, command, params, augeas_instance, files=None):
         msg = 'Augeas command execution error (command=%s, params=%s). %s' % (command, params,
-                                                                              self.format_augeas_errors(augeas_instance))
+                                                                              self.format_augeas_errors(augeas_instance,
+                                                                                                        files))
         super(CommandError, self).__init__(msg)
 
 
+class ScriptError(AugeasError):
+
+    def __init__(self, script, output, augeas_instance, files=None):
+        msg = ('Augeas script execution error:\n%s\n\naugeas output:\n%s\n\n%s' %
+               (script, output, self.format_augeas_errors(augeas_instance, files)))
+        super(ScriptError, self).__init__(msg)
+
+
+def literal_path_file(augeas_instance, path):
+    """Return loaded file which contains node pointed by path, found through
+    direct `/augeas/files<prefix>/path` lookups of path prefixes which don't
+    contain path expressions (None when there is no such file)"""
+    if not path.startswith('/files/'):
+        return None
+    prefix = ''
+    for segment in path[len('/files/'):].split('/'):
+        if not segment or PATH_EXPRESSION_RE.search(segment):
+            break
+        prefix += '/' + segment
+        if augeas_instance.match('/augeas/files%s/path' % prefix):
+            return prefix
+    return None
+
+
+def path_files(augeas_instance, path):
+    """Return loaded files which contain nodes pointed by path. Paths which
+    contain variables or path expressions before file name are evaluated on
+    the live tree - when path doesn't match anything (e.g. node is going to
+    be created), its closest matching ancestor is used."""
+    file_ = literal_path_file(augeas_instance, path)
+    if file_ is not None:
+        return [file_]
+    nodes = []
+    while path and not nodes:
+        try:
+            nodes = augeas_instance.match(path)
+        except (ValueError, RuntimeError):
+            pass
+        path = split_path(path)[0]
+    files = []
+    for node in nodes:
+        file_ = literal_path_file(augeas_instance, node)
+        if file_ is not None and file_ not in files:
+            files.append(file_)
+    return files
+
+
+def error_files(augeas_instance, paths, global_errors=False):
+    """Files which errors should be reported when commands operating on
+    given paths fail (None means all errors - see `global_errors` option -
+    also used when files can't be determined)"""
+    if global_errors:
+        return None
+    files = []
+    for path in paths:
+        for file_ in path_files(augeas_instance, path):
+            if file_ not in files:
+                files.append(file_)
+    return files or None
+
+
 class SetError(CommandError):
 
     error_type = 'put_failed'
@@ -376,58 +825,570 @@ class InsertError(CommandError):
     pass
 
 
-def execute(augeas_instance, commands):
-    results = []
-    changed = False
+class SpanError(CommandError):
+
+    pass
+
+
+class EnsureTreeError(CommandError):
+
+    pass
+
+
+class DefineError(CommandError):
+
+    pass
+
+
+def load_files(augeas_instance, commands):
+    """Register transform for every distinct (lens, file) pair used by commands
+    and load all of them at once (`load` reparses every registered file, so
+    doing it per command is really costly)"""
+    pairs = []
     for command, params in commands:
-        result = None
-        if 'lens' in params and 'file' in params:
-            lens = params['lens']
-            file_ = params['file']
-            if command != 'transform':
-                params['path'] = "/files%s/%s" % (file_, params['path'])
-                augeas_instance.transform(lens, file_)
-                augeas_instance.load()
-        if command == 'set':
-            path = params['path']
-            value = params['value']
-            if augeas_instance.get(path) != value:
-                try:
-                    augeas_instance.set(path, value)
-                except ValueError:
-                    raise SetError(command, params, augeas_instance)
-                result = changed = True
-            else:
-                result = False
-        elif command == 'rm':
-            path = params['path']
-            if augeas_instance.match(path):
-                augeas_instance.remove(path)
-                result = changed = True
+        if command != 'transform' and 'lens' in params and 'file' in params:
+            pair = (params['lens'], params['file'])
+            if pair not in pairs:
+                pairs.append(pair)
+    if not pairs:
+        return
+    for lens, file_ in pairs:
+        augeas_instance.transform(lens, file_)
+    # `aug_load_file` is available since augeas 1.13 and python-augeas 1.1
+    if hasattr(augeas_instance, 'load_file'):
+        for file_ in sorted(set(file_ for lens, file_ in pairs)):
+            augeas_instance.load_file(file_)
+    else:
+        augeas_instance.load()
+
+
+# arguments order of commands which can be passed to `aug_srun`
+SRUN_ARGS = {
+    'set': ['path', 'value'],
+    'rm': ['path'],
+    'ins': ['label', 'where', 'path'],
+    'defvar': ['name', 'expr'],
+    'defnode': ['name', 'expr', 'value']
+}
+
+
+def srun_line(command, params):
+    """Return `aug_srun` script line for given command or None if it can't
+    be safely quoted (augeas tokenizer splits script on new lines and
+    treats backslashes specially, so such commands go through python API)
+
+    >>> srun_line('set', {'path': '/files/etc/hosts/1/ipaddr', 'value': '127.0.0.1'})
+    'set "/files/etc/hosts/1/ipaddr" "127.0.0.1"'
+    >>> srun_line('rm', {'path': '/files/etc/iface[.="eth0"]'})
+    'rm "/files/etc/iface[.=\\\\"eth0\\\\"]"'
+    >>> srun_line('set', {'path': '/path', 'value': 'multi\\nline'}) is None
+    True
+    """
+    if command not in SRUN_ARGS:
+        return None
+    args = [params[a] for a in SRUN_ARGS[command]]
+    if any('\n' in a or '\\' in a for a in args):
+        return None
+    return ' '.join([command] + ['"%s"' % a.replace('"', '\\"') for a in args])
+
+
+def srun(augeas_instance, script):
+    """Execute script inside libaugeas (`aug_srun`) and return tuple
+    (return code, script output)"""
+    if hasattr(augeas_instance, 'srun'):
+        # public API of newer python-augeas
+        output = tempfile.TemporaryFile()
+        try:
+            ret = augeas_instance.srun(output, script)
+        except (ValueError, RuntimeError):
+            ret = -1
+        output.flush()
+        output.seek(0)
+        return (0 if ret is None else ret), output.read().decode('utf-8')
+    libc = ctypes.CDLL(ctypes.util.find_library('c'))
+    libc.fdopen.restype = ctypes.c_void_p
+    libc.fdopen.argtypes = [ctypes.c_int, ctypes.c_char_p]
+    libc.fclose.argtypes = [ctypes.c_void_p]
+    output = tempfile.TemporaryFile()
+    stream = libc.fdopen(os.dup(output.fileno()), b'w')
+    try:
+        # older bindings without public `srun` keep handle in private `__handle` attribute
+        handle = augeas_instance._Augeas__handle
+        if hasattr(augeas_instance, '_libaugeas'):
+            # ctypes based python-augeas (< 1.0)
+            ret = augeas_instance._libaugeas.aug_srun(handle, ctypes.c_void_p(stream), script)
+        else:
+            # cffi based python-augeas
+            from augeas.ffi import ffi, lib
+            ret = lib.aug_srun(handle, ffi.cast('FILE *', stream), script.encode('utf-8'))
+    finally:
+        libc.fclose(stream)
+    output.seek(0)
+    return ret, output.read().decode('utf-8')
+
+
+def execute_script(augeas_instance, commands, global_errors=False):
+    script = '\n'.join(srun_line(command, params) for command, params in commands)
+    ret, output = srun(augeas_instance, script)
+    if ret < 0:
+        raise ScriptError(script, output, augeas_instance,
+                          error_files(augeas_instance, [command_path(params) for command, params in commands],
+                                      global_errors))
+    # `aug_srun` doesn't report per command modifications - results of
+    # modifying commands are filled after save (see `srun_results`)
+    return [(format_command(command, params), None) for command, params in commands]
+
+
+def srun_results(augeas_instance, results, pending):
+    """Set results of modifying commands executed by `aug_srun` - pending
+    is list of (results index, command path) tuples. Command result is True
+    when any file it touched was saved (any file at all when its files can't
+    be determined)."""
+    saved = [augeas_instance.get(s)[len('/files'):] for s in augeas_instance.match('/augeas/events/saved')]
+    for index, path in pending:
+        files = path_files(augeas_instance, path)
+        results[index] = (results[index][0], any(f in saved for f in files) if files else bool(saved))
+
+
+def normalize_subpath(subpath):
+    """Drop "[1]" position predicates - augeas uses them only for labels
+    which have many siblings with the same name
+
+    >>> normalize_subpath('alias[1]/a[1]/b[2]')
+    'alias/a/b[2]'
+    """
+    return re.sub(r'\[1\](?=/|$)', '', subpath)
+
+
+def natural_key(path):
+    return [int(p) if p.isdigit() else p for p in re.split(r'(\d+)', path)]
+
+
+def ensure_tree(augeas_instance, path, values, prune=False):
+    """Set values (relative path -> value) beneath `path` reading current
+    subtree only once. With `prune` all other nodes (except comments) are
+    removed. Returns True when tree was modified.
+
+    New nodes are appended in order of `values` mapping:
+
+    >>> from collections import OrderedDict
+    >>> class Recorder(object):
+    ...     def __init__(self):
+    ...         self.paths = []
+    ...     def match(self, path):
+    ...         return []
+    ...     def set(self, path, value):
+    ...         self.paths.append(path[len('/files/etc/ssh/sshd_config/'):])
+    >>> recorder = Recorder()
+    >>> values = OrderedDict([('AllowUsers/%d' % i, 'u%d' % i) for i in range(1, 12)] +
+    ...                      [('PermitRootLogin', 'no'), ('Match/Condition/User', 'git')])
+    >>> ensure_tree(recorder, '/files/etc/ssh/sshd_config', values)
+    True
+    >>> recorder.paths[8:]
+    ['AllowUsers/9', 'AllowUsers/10', 'AllowUsers/11', 'PermitRootLogin', 'Match/Condition/User']
+    """
+    nodes = augeas_instance.match(path)
+    if len(nodes) > 1:
+        raise ValueError('Path matches multiple nodes: %s' % path)
+    base = nodes[0] if nodes else path
+    current = {}
+    if nodes:
+        for node in augeas_instance.match(base + '//*'):
+            current[normalize_subpath(node[len(base) + 1:])] = node
+
+    modified = False
+    wanted = set()
+    for subpath, value in values.items():
+        key = normalize_subpath(subpath)
+        wanted.add(key)
+        if key not in current or augeas_instance.get(current[key]) != value:
+            augeas_instance.set(base + '/' + subpath, value)
+            modified = True
+
+    if prune:
+        keep = set()
+        for key in wanted:
+            parts = key.split('/')
+            keep.update('/'.join(parts[:i]) for i in range(1, len(parts) + 1))
+        obsolete = [k for k in current if k not in keep and not k.split('/')[-1].startswith('#')]
+        # remove only top most nodes - in reversed order, so positions
+        # of remaining siblings don't change
+        obsolete = [k for k in obsolete
+                    if not any(k.startswith(o + '/') for o in obsolete)]
+        for key in sorted(obsolete, key=natural_key, reverse=True):
+            augeas_instance.remove(current[key])
+            modified = True
+    return modified
+
+
+def split_path(path):
+    """Split path into parent path and last segment (slashes inside
+    predicates are ignored)
+
+    >>> split_path('/files/etc/ssh/sshd_config/AllowUsers/*')
+    ('/files/etc/ssh/sshd_config/AllowUsers', '*')
+    >>> split_path('/files/etc/hosts/*[canonical="a/b"]')
+    ('/files/etc/hosts', '*[canonical="a/b"]')
+    """
+    depth = 0
+    for i in range(len(path) - 1, -1, -1):
+        if path[i] == ']':
+            depth += 1
+        elif path[i] == '[':
+            depth -= 1
+        elif path[i] == '/' and depth == 0:
+            return path[:i], path[i + 1:]
+    return '', path
+
+
+def append_unique(augeas_instance, path, value):
+    """Append new node with given value after nodes matched by path, unless
+    any of them already has this value. For "*" (seq lists like
+    `AllowUsers/*`) next number of parent children is used as label. Node
+    is appended under parent of the last matched node (path can match
+    children of many parents, e.g. many `AllowUsers` entries). Returns True
+    when node was appended."""
+    nodes = augeas_instance.match(path)
+    if any(augeas_instance.get(n) == value for n in nodes):
+        return False
+    parent, segment = split_path(path)
+    label = segment.split('[', 1)[0]
+    if nodes:
+        parent = split_path(nodes[-1])[0]
+    else:
+        # parent path can still match many nodes - use the last one
+        parent = (augeas_instance.match(parent) or [parent])[-1]
+    if label == '*':
+        children = augeas_instance.match(parent + '/*')
+        numbers = [int(l) for l in (split_path(n)[1].split('[', 1)[0] for n in children) if l.isdigit()]
+        augeas_instance.set('%s/%s' % (parent, max(numbers + [0]) + 1), value)
+    else:
+        augeas_instance.set('%s/%s[last()+1]' % (parent, label), value)
+    return True
+
+
+def format_command(command, params, empty='""'):
+    # options with default values are skipped
+    defaults = dict((parser.name, parser(None)) for parser in COMMAND_OPTIONS.get(command, []))
+    return command + ' ' + ' '.join(format_param(v, empty) for k, v in params.items()
+                                    if k not in defaults or v != defaults[k])
+
+
+def match(augeas_instance, path, limit=None, offset=None, count_only=False,
+          fields=('label', 'value'), format_='rows'):
+    """Match nodes and return (paginated) list of {"label", "value"} dicts,
+    {"labels", "values"} columns or just nodes count. Values are fetched only
+    when they are requested."""
+    nodes = augeas_instance.match(path)
+    if count_only:
+        return len(nodes)
+    nodes = nodes[offset or 0:]
+    if limit is not None:
+        nodes = nodes[:limit]
+    values = [augeas_instance.get(n) for n in nodes] if 'value' in fields else None
+    if format_ == 'columns':
+        result = {}
+        if 'label' in fields:
+            result['labels'] = nodes
+        if values is not None:
+            result['values'] = values
+        return result
+    rows = [{} for n in nodes]
+    for row, node in zip(rows, nodes):
+        if 'label' in fields:
+            row['label'] = node
+    if values is not None:
+        for row, value in zip(rows, values):
+            row['value'] = value
+    return rows
+
+
+def path_label(path):
+    """Return label of node pointed by path (last segment without position)
+
+    >>> path_label('/files/etc/hosts/1/alias[2]')
+    'alias'
+    >>> path_label('/files/etc/fstab/#comment[10]')
+    '#comment'
+    """
+    return re.sub(r'\[\d+\]$', '', re.split(r'(?<!\\)/', path)[-1])
+
+
+def parent_path(path):
+    """Return path of parent node
+
+    >>> parent_path('/files/etc/hosts/1/alias[2]')
+    '/files/etc/hosts/1'
+    """
+    return '/'.join(re.split(r'(?<!\\)/', path)[:-1])
+
+
+def nest_levels(levels, values):
+    """Nest nodes collected level by level (matched nodes first, then their
+    children etc.) into {"label", "value", "children"} trees - every node is
+    attached to the node of previous level which path is its parent path
+
+    >>> nest_levels([['/a', '/b'], ['/a/x', '/b/y[1]', '/b/y[2]']],
+    ...             {'/a': '1', '/b': None, '/a/x': '2', '/b/y[1]': '3', '/b/y[2]': '4'}) == \\
+    ...     [{'path': '/a', 'label': 'a', 'value': '1', 'children': [{'label': 'x', 'value': '2', 'children': []}]},
+    ...      {'path': '/b', 'label': 'b', 'value': None, 'children': [{'label': 'y', 'value': '3', 'children': []},
+    ...                                                              {'label': 'y', 'value': '4', 'children': []}]}]
+    True
+    """
+    tree = []
+    previous = {}
+    for level, nodes in enumerate(levels):
+        current = {}
+        for node in nodes:
+            item = {'label': path_label(node), 'value': values[node], 'children': []}
+            if level == 0:
+                item['path'] = node
+                tree.append(item)
             else:
-                result = False
-        elif command == 'ins':
-            path = params['path']
-            label = params['label']
-            where = params['where']
+                previous[parent_path(node)]['children'].append(item)
+            current[node] = item
+        previous = current
+    return tree
+
+
+def export(augeas_instance, path, depth=None, max_nodes=None):
+    """Export nodes matched by path as nested {"label", "value", "children"}
+    trees (matched nodes contain also their "path"). Returns {"tree", "nodes",
+    "truncated"} object - "truncated" is set when the walk was stopped after
+    `max_nodes` nodes.
+
+    Nodes are collected level by level - one `match` per level and one `get`
+    per node. With `max_nodes` every level expression is restricted by
+    position predicate to the remaining budget, so huge levels are never
+    matched whole (budget limits number of children of every parent)."""
+    levels = []
+    count = 0
+    truncated = False
+    while depth is None or len(levels) <= depth:
+        expression = path + '/*' * len(levels)
+        if max_nodes is not None:
+            # one more node tells that the level doesn't fit into the budget
+            expression += '[position() <= %d]' % (max_nodes - count + 1)
+        nodes = augeas_instance.match(expression)
+        if not nodes:
+            break
+        if max_nodes is not None and count + len(nodes) > max_nodes:
+            nodes = nodes[:max_nodes - count]
+            truncated = True
+        levels.append(nodes)
+        count += len(nodes)
+        if truncated:
+            break
+    values = dict((node, augeas_instance.get(node)) for nodes in levels for node in nodes)
+    return {'tree': nest_levels(levels, values), 'nodes': count, 'truncated': truncated}
+
+
+def execute_timed_script(augeas_instance, script, timings=None, global_errors=False):
+    started = time.time()
+    results = execute_script(augeas_instance, script, global_errors)
+    if timings is not None:
+        timings['commands'].append({'command': 'srun (%d commands)' % len(script), 'time': time.time() - started})
+    return results
+
+
+def execute_command(augeas_instance, command, params, global_errors=False):
+    """Execute single command - returns tuple (result, changed). Other augeas
+    failures (e.g. ambiguous or invalid path expression passed to `get` or
+    `match`) are raised as `CommandError` too."""
+    try:
+        return _execute_command(augeas_instance, command, params, global_errors)
+    # python-augeas >= 1.0 raises AugeasValueError and AugeasRuntimeError
+    # which are subclasses of these
+    except (ValueError, RuntimeError):
+        raise CommandError(command, params, augeas_instance,
+                           error_files(augeas_instance, [command_path(params)], global_errors))
+
+
+def _execute_command(augeas_instance, command, params, global_errors=False):
+    result = None
+    changed = False
+    if command == 'set':
+        path = params['path']
+        value = params['value']
+        if augeas_instance.get(path) != value:
             try:
-                augeas_instance.insert(path, label, where == 'before')
+                augeas_instance.set(path, value)
             except ValueError:
-                raise InsertError(command, params, augeas_instance)
+                raise SetError(command, params, augeas_instance,
+                               error_files(augeas_instance, [params['path']], global_errors))
             result = changed = True
-        elif command == 'transform':
-            excl = params['filter'] == 'excl'
-            augeas_instance.transform(lens, file_, excl)
-        elif command == 'load':
-            augeas_instance.load()
-        else: # match
-            result = [{'label': s, 'value': augeas_instance.get(s)} for s in augeas_instance.match(params['path'])]
-        results.append((command + ' ' + ' '.join(p if p else '""' for p in params.values()), result))
-
+        else:
+            result = False
+    elif command == 'rm':
+        path = params['path']
+        if augeas_instance.match(path):
+            augeas_instance.remove(path)
+            result = changed = True
+        else:
+            result = False
+    elif command == 'ins':
+        path = params['path']
+        label = params['label']
+        where = params['where']
+        try:
+            augeas_instance.insert(path, label, where == 'before')
+        except ValueError:
+            raise InsertError(command, params, augeas_instance,
+                              error_files(augeas_instance, [params['path']], global_errors))
+        result = changed = True
+    elif command == 'transform':
+        excl = params['filter'] == 'excl'
+        augeas_instance.transform(params['lens'], params['file'], excl)
+    elif command == 'load':
+        augeas_instance.load()
+    elif command == 'ensure_tree':
+        try:
+            result = ensure_tree(augeas_instance, params['path'], params['values'], params['prune'])
+        except ValueError:
+            raise EnsureTreeError(command, params, augeas_instance,
+                                  error_files(augeas_instance, [params['path']], global_errors))
+        changed = changed or result
+    elif command == 'set-if-missing':
+        result = False
+        if not augeas_instance.match(params['path']):
+            try:
+                augeas_instance.set(params['path'], params['value'])
+            except ValueError:
+                raise SetError(command, params, augeas_instance,
+                               error_files(augeas_instance, [params['path']], global_errors))
+            result = changed = True
+    elif command == 'append-unique':
+        try:
+            result = append_unique(augeas_instance, params['path'], params['value'])
+        except ValueError:
+            raise SetError(command, params, augeas_instance,
+                           error_files(augeas_instance, [params['path']], global_errors))
+        changed = changed or result
+    elif command == 'rm-if-value':
+        nodes = [n for n in augeas_instance.match(params['path'])
+                 if augeas_instance.get(n) == params['value']]
+        # positions of remaining siblings don't change when removing from the end
+        for node in reversed(nodes):
+            augeas_instance.remove(node)
+        result = bool(nodes)
+        changed = changed or result
+    elif command == 'defvar':
+        try:
+            augeas_instance.defvar(params['name'], params['expr'])
+        except ValueError:
+            raise DefineError(command, params, augeas_instance,
+                              error_files(augeas_instance, [params['expr']], global_errors))
+    elif command == 'defnode':
+        # node is created when expression doesn't match anything
+        result = not augeas_instance.match(params['expr'])
+        try:
+            augeas_instance.defnode(params['name'], params['expr'], params['value'])
+        except ValueError:
+            raise DefineError(command, params, augeas_instance,
+                              error_files(augeas_instance, [params['expr']], global_errors))
+        changed = changed or result
+    elif command == 'span':
+        result = []
+        for s in augeas_instance.match(params['path']):
+            try:
+                filename, label_start, label_end, value_start, value_end, span_start, span_end = augeas_instance.span(s)
+            except ValueError:
+                raise SpanError(command, params, augeas_instance,
+                                error_files(augeas_instance, [params['path']], global_errors))
+            result.append({'label': s, 'value': augeas_instance.get(s), 'file': filename,
+                           'label_start': label_start, 'label_end': label_end,
+                           'value_start': value_start, 'value_end': value_end,
+                           'span_start': span_start, 'span_end': span_end})
+    elif command == 'export':
+        result = export(augeas_instance, params['path'], params.get('depth'), params.get('max_nodes'))
+    else: # match
+        result = match(augeas_instance, params['path'], params.get('limit'), params.get('offset'),
+                       params.get('count_only', False), params.get('fields', ['label', 'value']),
+                       params.get('format', 'rows'))
+    return result, changed
+
+
+def command_path(params):
+    return params.get('path') or params.get('expr') or ''
+
+
+def execute(augeas_instance, commands, engine='api', timings=None, global_errors=False, check=False,
+            errors=None, transforms=True):
+    """Execute commands and save changes - returns tuple (results, changed).
+    Transforms of `lens` and `file` commands are registered and loaded only
+    with `transforms` (trees cached by worker already contain them).
+
+    In `check` mode changes are saved in augeas "noop" save mode, so files
+    which would be changed are reported (`/augeas/events/saved`) but nothing
+    is written. When `errors` list is given, messages of failing commands
+    are appended to it and execution continues with the next command."""
+    results = []
+    changed = False
+    # whether any command could have modified the tree
+    modified = False
+    # paths of modifying commands - errors of their files are reported on save failure
+    touched = []
+    # (results index, path) of modifying commands executed by `aug_srun`
+    pending = []
+    if timings is not None:
+        timings['commands'] = []
+        started = time.time()
+    if transforms:
+        load_files(augeas_instance, commands)
+    if timings is not None:
+        timings['load_files'] = time.time() - started
+    script = []
+    for command, params in commands:
+        started = time.time()
+        if command != 'transform' and 'lens' in params and 'file' in params:
+            params['path'] = "/files%s/%s" % (params['file'], params['path'])
+        if engine == 'srun' and srun_line(command, params) is not None:
+            script.append((command, params))
+            if command not in READ_ONLY_COMMANDS:
+                modified = True
+                touched.append(command_path(params))
+            continue
+        if script:
+            pending.extend((len(results) + i, command_path(p))
+                           for i, (c, p) in enumerate(script) if c not in READ_ONLY_COMMANDS)
+            results.extend(execute_timed_script(augeas_instance, script, timings, global_errors))
+            script = []
+        try:
+            result, command_changed = execute_command(augeas_instance, command, params, global_errors)
+        except AugeasError as e:
+            if errors is None:
+                raise
+            errors.append(e.msg)
+            results.append((format_command(command, params), None))
+            continue
+        changed = changed or command_changed
+        modified = modified or changed
+        if command not in READ_ONLY_COMMANDS:
+            touched.append(command_path(params))
+        results.append((format_command(command, params), result))
+        if timings is not None:
+            timings['commands'].append({'command': results[-1][0], 'time': time.time() - started})
+    if script:
+        pending.extend((len(results) + i, command_path(p))
+                       for i, (c, p) in enumerate(script) if c not in READ_ONLY_COMMANDS)
+        results.extend(execute_timed_script(augeas_instance, script, timings, global_errors))
+
+    # read only run - there is nothing to save
+    if not modified:
+        return results, False
+
+    started = time.time()
+    if check:
+        augeas_instance.set('/augeas/save', 'noop')
     try:
         augeas_instance.save()
     except IOError:
-        raise SaveError(augeas_instance)
+        e = SaveError(augeas_instance, error_files(augeas_instance, touched, global_errors))
+        if errors is None:
+            raise e
+        errors.append(e.msg)
+    if timings is not None:
+        timings['save'] = time.time() - started
 
     # https://github.com/hercules-team/augeas/wiki/Change-how-files-are-saved
     changed_files = augeas_instance.match('/augeas/events/saved')
@@ -436,91 +1397,1054 @@ def execute(augeas_instance, commands):
         changed = True
     else:
         changed = False
+    if pending:
+        srun_results(augeas_instance, results, pending)
 
     return results, changed
 
+
+def file_lens(augeas_instance, file_):
+    """Return name of lens which handles given file (None when it's unknown)"""
+    lens = augeas_instance.get('/augeas/files%s/lens' % file_)
+    if lens is None:
+        # file which is going to be created - look for transform which includes it
+        for transform in augeas_instance.match('/augeas/load/*'):
+            incl = [augeas_instance.get(p) for p in augeas_instance.match(transform + '/incl')]
+            excl = [augeas_instance.get(p) for p in augeas_instance.match(transform + '/excl')]
+            if any(glob_match(i, file_) for i in incl) and not any(glob_match(e, file_) for e in excl):
+                return augeas_instance.get(transform + '/lens')
+    elif lens.startswith('@'):
+        # autoloaded module ("@Module") - lens name is kept by its transform
+        lens = augeas_instance.get('/augeas/load/%s/lens' % lens[1:])
+    return lens
+
+
+def saved_diffs(augeas_instance, root):
+    """Return diffs (in Ansible "diff" format) of files reported by last save
+    (`/augeas/events/saved`) - this works also with "noop" save mode. New
+    content of every file is generated with `aug_text_retrieve`, so diffs
+    are not available with bindings which don't support it."""
+    diffs = []
+    if not hasattr(augeas_instance, 'text_retrieve'):
+        return diffs
+    for node in augeas_instance.match('/augeas/events/saved'):
+        file_ = augeas_instance.get(node)[len('/files'):]
+        lens = file_lens(augeas_instance, file_)
+        if lens is None:
+            continue
+        try:
+            with open(os.path.join(root, file_.lstrip('/'))) as f:
+                before = f.read()
+        except IOError:
+            before = ''
+        try:
+            augeas_instance.set('/text/before', before)
+            augeas_instance.text_retrieve(lens, '/text/before', '/files' + file_, '/text/after')
+            after = augeas_instance.get('/text/after')
+        except ValueError:
+            continue
+        finally:
+            augeas_instance.remove('/text')
+        diffs.append({'before_header': file_, 'after_header': file_, 'before': before, 'after': after})
+    return diffs
+
+
+# any of these characters in path segment means that we are not able to
+# resolve file without augeas path expression evaluation
+PATH_EXPRESSION_RE = re.compile(r'[*?\[\]$()|=]|^\.\.?$')
+
+
+def resolve_file(path, root):
+    """Return file (relative to augeas root) which contains node pointed by
+    given "/files/..." path or None when it can't be determined without
+    evaluation of augeas path expression.
+
+    >>> resolve_file('/augeas/files//error', '/') is None
+    True
+    >>> resolve_file('/files/*/hosts', '/') is None
+    True
+    """
+    if not path.startswith('/files/'):
+        return None
+    file_ = ''
+    for segment in path[len('/files/'):].split('/'):
+        if not segment or PATH_EXPRESSION_RE.search(segment):
+            return None
+        file_ += '/' + segment
+        if os.path.isfile(os.path.join(root, file_.lstrip('/'))):
+            return file_
+    return None
+
+
+def expand_variables(path, variables):
+    """Replace leading path variable (defined by `defvar` or `defnode`)
+    with its expression
+
+    >>> expand_variables('$iface/family', {'iface': '/files/etc/network/interfaces/iface[1]'})
+    '/files/etc/network/interfaces/iface[1]/family'
+    >>> expand_variables('$unknown/family', {})
+    '$unknown/family'
+    """
+    match = re.match(r'\$([^/\[]+)', path)
+    if match and match.group(1) in variables:
+        return variables[match.group(1)] + path[match.end():]
+    return path
+
+
+def commands_files(commands, root):
+    """Return set of files touched by commands or None when any of them
+    can't be resolved (see `resolve_file`). Commands which use explicit
+    lens and file are skipped - their files are transformed anyway."""
+    files = set()
+    variables = {}
+    for command, params in commands:
+        if command in ('defvar', 'defnode'):
+            path = variables[params['name']] = expand_variables(params['expr'], variables)
+        elif 'path' not in params or 'lens' in params:
+            continue
+        else:
+            path = expand_variables(params['path'], variables)
+        file_ = resolve_file(path, root)
+        if file_ is None:
+            return None
+        files.add(file_)
+    return files
+
+
+def glob_match(pattern, path):
+    """Match path against augeas transform glob (wildcards don't cross "/")
+
+    >>> glob_match('/etc/*.conf', '/etc/resolv.conf')
+    True
+    >>> glob_match('/etc/*.conf', '/etc/ld.so.conf.d/libc.conf')
+    False
+    """
+    pattern, path = pattern.split('/'), path.split('/')
+    return (len(pattern) == len(path) and
+            all(fnmatch.fnmatchcase(s, p) for p, s in zip(pattern, path)))
+
+
+def glob_excluded(patterns, path):
+    """Whether path is excluded by any of augeas transform `excl` patterns -
+    relative patterns (e.g. "*.rpmsave") match file name
+
+    >>> glob_excluded(['*.rpmsave', '*~'], '/etc/hosts.rpmsave')
+    True
+    >>> glob_excluded(['/etc/*.d/*.bak'], '/etc/sudoers.d/admins.bak')
+    True
+    >>> glob_excluded(['*.rpmsave', '/etc/*.d/*.bak'], '/etc/hosts')
+    False
+    """
+    return any(glob_match(e, path) or (not e.startswith('/') and fnmatch.fnmatchcase(os.path.basename(path), e))
+               for e in patterns)
+
+
+def selective_load(augeas_instance, files):
+    """Restrict autoloaded transforms (`/augeas/load/*`) to given files and load
+    only them. Augeas instance should be created with `NO_LOAD` flag."""
+    for transform in augeas_instance.match('/augeas/load/*'):
+        incl = [augeas_instance.get(p) for p in augeas_instance.match(transform + '/incl')]
+        excl = [augeas_instance.get(p) for p in augeas_instance.match(transform + '/excl')]
+        matched = [f for f in files if any(glob_match(i, f) for i in incl) and not glob_excluded(excl, f)]
+        if matched:
+            augeas_instance.remove(transform + '/incl')
+            augeas_instance.remove(transform + '/excl')
+            for file_ in sorted(matched):
+                augeas_instance.set(transform + '/incl[last()+1]', file_)
+        else:
+            augeas_instance.remove(transform)
+    augeas_instance.load()
+
+
+def open_augeas(root, loadpath, flags, files=None, timings=None):
+    """Create augeas instance - when files are given only these are parsed
+    (see `selective_load`). When `timings` dict is given, initialization and
+    files loading durations are measured separately."""
+    if files is not None or timings is not None:
+        flags = flags | getattr(Augeas, 'NO_LOAD', 0)
+    started = time.time()
+    augeas_instance = Augeas(root=root, loadpath=loadpath, flags=flags)
+    if timings is not None:
+        timings['init'] = time.time() - started
+        started = time.time()
+    if files is not None:
+        selective_load(augeas_instance, files)
+    elif timings is not None:
+        augeas_instance.load()
+    if timings is not None:
+        timings['load'] = time.time() - started
+    return augeas_instance
+
+
+def loaded_files(augeas_instance):
+    """Return "/files/..." paths of files loaded into the tree. Errors of
+    files (`/augeas/files/<file>/error`) have their own `path` child, so only
+    top most entries with `path` are taken.
+
+    >>> class Tree(object):
+    ...     nodes = {'/augeas/files/etc/hosts/path': '/files/etc/hosts',
+    ...              '/augeas/files/etc/hosts/error/path': '/files/etc/hosts/3',
+    ...              '/augeas/files/etc/fstab/path': '/files/etc/fstab'}
+    ...     def match(self, path):
+    ...         return sorted(n[:-len('/path')] for n in self.nodes)
+    ...     def get(self, path):
+    ...         return self.nodes[path]
+    >>> loaded_files(Tree())
+    ['/files/etc/fstab', '/files/etc/hosts']
+    """
+    nodes = augeas_instance.match('/augeas/files//*[path]')
+    entries = set(nodes)
+    files = []
+    for node in nodes:
+        parent = parent_path(node)
+        while parent and parent not in entries:
+            parent = parent_path(parent)
+        if not parent:
+            files.append(augeas_instance.get(node + '/path'))
+    return files
+
+
+def profile_summary(augeas_instance, timings):
+    """Add loaded files nodes counts and peak RSS to timings"""
+    timings['nodes'] = {}
+    if augeas_instance is not None:
+        for file_ in loaded_files(augeas_instance):
+            timings['nodes'][file_[len('/files'):]] = len(augeas_instance.match(file_ + '//*'))
+    # kilobytes on Linux
+    timings['peak_rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return timings
+
+
+WORKER_SOCKET = os.path.join('~', '.ansible', 'tmp', 'augeas-worker.sock')
+
+
+def loaded_files_fingerprints(augeas_instance, root):
+    """Return dict: file -> (mtime, size) for all files loaded into the tree"""
+    fingerprints = {}
+    for path in loaded_files(augeas_instance):
+        file_ = path[len('/files'):]
+        try:
+            stat = os.stat(os.path.join(root, file_.lstrip('/')))
+            fingerprints[file_] = (stat.st_mtime, stat.st_size)
+        except OSError:
+            fingerprints[file_] = None
+    return fingerprints
+
+
+def transform_files(augeas_instance, root):
+    """Return files (relative to root) which exist on disk and are included
+    by tree transforms (`/augeas/load/*`) - these are the files which `load()`
+    would parse now"""
+    files = set()
+    for transform in augeas_instance.match('/augeas/load/*'):
+        incl = [augeas_instance.get(p) for p in augeas_instance.match(transform + '/incl')]
+        excl = [augeas_instance.get(p) for p in augeas_instance.match(transform + '/excl')]
+        for pattern in incl:
+            for path in glob.glob(os.path.join(root, pattern.lstrip('/'))):
+                file_ = '/' + os.path.relpath(path, root)
+                if os.path.isfile(path) and not glob_excluded(excl, file_):
+                    files.add(file_)
+    return files
+
+
+class Worker(object):
+    """Long living process which keeps parsed augeas trees (keyed by root,
+    loadpath, flags, selectively loaded files and `lens`/`file` transforms)
+    between module invocations.
+    It accepts one JSON request per unix socket connection and exits after
+    `idle_timeout` seconds without requests."""
+
+    def __init__(self, socket_path, idle_timeout, version):
+        self.socket_path = socket_path
+        self.idle_timeout = idle_timeout
+        # `module_version` of the module which started the worker
+        self.version = version
+        # key -> (augeas instance, loaded files fingerprints, lenses fingerprint)
+        self.trees = {}
+
+    def serve(self):
+        # only one worker per socket - lock is held until process exits
+        lock = open(self.socket_path + '.lock', 'w')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            return
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o077)
+        try:
+            server.bind(self.socket_path)
+        finally:
+            os.umask(umask)
+        server.listen(16)
+        server.settimeout(self.idle_timeout)
+        try:
+            while True:
+                try:
+                    connection, _ = server.accept()
+                except socket.timeout:
+                    break
+                try:
+                    connection.settimeout(None)
+                    request = json.loads(receive_message(connection))
+                    response = self.handle(request)
+                    connection.sendall(json.dumps(response).encode('utf-8'))
+                finally:
+                    connection.close()
+                # module was upgraded - next request starts new worker
+                if response.get('stale'):
+                    break
+        finally:
+            server.close()
+            os.unlink(self.socket_path)
+
+    def handle(self, request):
+        if request.get('version') != self.version:
+            return {'stale': True}
+        try:
+            results, changed = self.execute(request)
+        except AugeasError as e:
+            return {'failed': True, 'msg': e.msg}
+        except Exception as e:
+            return {'failed': True, 'msg': 'Augeas worker error: %s' % e}
+        return {'results': results, 'changed': changed}
+
+    def augeas_instance(self, key, root, loadpath, flags, files, lenses):
+        """Return cached augeas instance (files which changed on disk or were
+        created after the tree was loaded are (re)loaded) or create new one
+        when there is no tree parsed with current lenses"""
+        if key in self.trees and self.trees[key][2] != lenses:
+            del self.trees[key]
+        if key in self.trees:
+            # tree is dropped until request succeeds - revalidation can fail too
+            augeas_instance, fingerprints, lenses = self.trees.pop(key)
+            current = loaded_files_fingerprints(augeas_instance, root)
+            changed = [f for f in current if current[f] != fingerprints.get(f)]
+            # otherwise changes of new files would be saved over their content
+            changed.extend(f for f in sorted(transform_files(augeas_instance, root)) if f not in current)
+            if changed:
+                if hasattr(augeas_instance, 'load_file'):
+                    for file_ in changed:
+                        augeas_instance.load_file(file_)
+                else:
+                    augeas_instance.load()
+            return augeas_instance
+        return open_augeas(root, loadpath, flags, files)
+
+    def execute(self, request):
+        # root is resolved by the module (worker environment can differ)
+        root = request['root']
+        commands = [(command, params) for command, params in request['commands']]
+        # transforms registered for `lens` and `file` stay in the tree, so
+        # trees are shared only by requests which register the same ones
+        transforms = sorted(set((p['lens'], p['file']) for c, p in commands
+                                if c != 'transform' and 'lens' in p and 'file' in p))
+        key = json.dumps([root, request['loadpath'], request['flags'], request['files'], transforms])
+        lock_dir = request.get('lock_dir')
+        # files are revalidated under locks, so changes saved concurrently aren't overwritten
+        with FileLocks(lock_dir or LOCK_DIR, root, commands_locks(commands, root) if lock_dir else set()):
+            cached = key in self.trees and self.trees[key][2] == request['lenses']
+            augeas_instance = self.augeas_instance(key, root, request['loadpath'],
+                                                   request['flags'], request['files'], request['lenses'])
+            # tree is in unknown state after failure - it is not cached again
+            results, changed = execute(augeas_instance, commands, engine=request['engine'],
+                                       global_errors=request.get('global_errors', False),
+                                       transforms=not cached)
+            # explicit transforms change files which are loaded by the tree
+            if all(c not in ('transform', 'load') for c, p in commands):
+                # variables can't leak into following requests
+                for name in set(p['name'] for c, p in commands if c in ('defvar', 'defnode')):
+                    augeas_instance.defvar(name, None)
+                self.trees[key] = (augeas_instance, loaded_files_fingerprints(augeas_instance, root),
+                                   request['lenses'])
+        return results, changed
+
+
+def receive_message(connection):
+    chunks = []
+    while True:
+        chunk = connection.recv(65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    return b''.join(chunks).decode('utf-8')
+
+
+def module_version():
+    """Return hash of module source (None when it is not available) - worker
+    started by different version of the module is not used"""
+    try:
+        source = inspect.getsource(sys.modules[__name__])
+    except (IOError, OSError, TypeError):
+        return None
+    return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+
+def start_worker(socket_path, idle_timeout, version):
+    """Start detached worker process (double fork, so it's not a child of the
+    module process and doesn't hold ansible's stdout open)"""
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.setsid()
+            if os.fork() == 0:
+                devnull = os.open(os.devnull, os.O_RDWR)
+                for fd in (0, 1, 2):
+                    os.dup2(devnull, fd)
+                Worker(socket_path, idle_timeout, version).serve()
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+
+
+def worker_execute(socket_path, idle_timeout, request):
+    """Pass request to the worker (it's started on first use) and return its
+    response or None when worker is not available or it was started by
+    different version of the module (it exits then)"""
+    socket_path = os.path.expanduser(socket_path)
+    directory = os.path.dirname(socket_path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory, 0o700)
+    for attempt in range(50):
+        # don't talk to sockets created by other users
+        if os.path.exists(socket_path) and os.stat(socket_path).st_uid == os.getuid():
+            connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                connection.connect(socket_path)
+                connection.sendall(json.dumps(request).encode('utf-8'))
+                connection.shutdown(socket.SHUT_WR)
+                response = json.loads(receive_message(connection))
+                return None if response.get('stale') else response
+            except socket.error:
+                pass
+            finally:
+                connection.close()
+        if attempt == 0:
+            start_worker(socket_path, idle_timeout, request['version'])
+        time.sleep(0.1)
+    return None
+
+
+# options which describe single task commands (see `batch` option)
+TASK_OPTIONS = ['command', 'path', 'value', 'values', 'prune', 'commands', 'where', 'label', 'lens', 'file',
+                'filter', 'limit', 'offset', 'count_only', 'fields', 'format', 'depth', 'max_nodes']
+
+# commands which don't modify the tree
+READ_ONLY_COMMANDS = ['match', 'span', 'transform', 'load', 'defvar', 'export']
+
+
+def build_commands(params):
+    """Build commands list from module (or single `batch` task) options
+
+    >>> options = lambda **params: dict((o, params.get(o)) for o in TASK_OPTIONS)
+    >>> assert (build_commands(options(command='set', path='/files/etc/hosts/1/ipaddr', value='127.0.0.1')) ==
+    ...         [('set', {'path': '/files/etc/hosts/1/ipaddr', 'value': '127.0.0.1'})])
+    >>> assert (build_commands(options(commands='set /files/etc/hosts/1/ipaddr 127.0.0.1 rm /files/etc/hosts/2')) ==
+    ...         [('set', {'path': '/files/etc/hosts/1/ipaddr', 'value': '127.0.0.1'}),
+    ...          ('rm', {'path': '/files/etc/hosts/2'})])
+    >>> assert (build_commands(options(command='rm', path='AllowUsers/1', lens='sshd', file='/etc/ssh/sshd_config')) ==
+    ...         [('rm', {'path': 'AllowUsers/1', 'lens': 'sshd', 'file': '/etc/ssh/sshd_config'})])
+    >>> assert (build_commands(options(command='match', path='/files/etc/hosts/*')) ==
+    ...         [('match', {'path': '/files/etc/hosts/*', 'limit': None, 'offset': None, 'count_only': False,
+    ...                     'fields': ['label', 'value'], 'format': 'rows'})])
+    >>> build_commands(options(command='set', path='/files/etc/hosts/1/ipaddr'))
+    Traceback (most recent call last):
+    ...
+    CommandsParseError: You should use "value" argument with "set" command.
+    """
+    if params['command'] is None:
+        if params['commands'] is None:
+            raise CommandsParseError('You have to use "command" or "commands" argument.')
+        return parse_commands(params['commands'])
+    command = params['command']
+    if command in ('set', 'set-if-missing', 'append-unique', 'rm-if-value'):
+        if params['value'] is None:
+            raise CommandsParseError('You should use "value" argument with "%s" command.' % command)
+        command_params = {'path': params['path'], 'value': params['value']}
+    elif command == 'ins':
+        if params['label'] is None:
+            raise CommandsParseError('You have to use "label" argument with "ins" command.')
+        if params['path'] is None:
+            raise CommandsParseError('You have to use "path" argument with "ins" command.')
+        command_params = {'label': params['label'], 'path': params['path'],
+                          'where': params['where'] or 'before'}
+    elif command == 'transform':
+        command_params = {'lens': params['lens'], 'file': params['file'],
+                          'filter': params['filter']}
+    elif command == 'load':
+        command_params = {}
+    elif command == 'ensure_tree':
+        if params['values'] is None:
+            raise CommandsParseError('You have to use "values" argument with "ensure_tree" command.')
+        command_params = {'path': params['path'], 'values': MappingParser('values')(params['values']),
+                          'prune': BooleanParser('prune')(params['prune'])}
+    elif command in ('match', 'export'):
+        command_params = {'path': params['path']}
+        for parser in COMMAND_OPTIONS[command]:
+            command_params[parser.name] = parser(params[parser.name])
+    else: # rm or span
+        command_params = {'path': params['path']}
+    if operator.xor(bool(params['lens']), bool(params['file'])):
+        raise CommandsParseError('Both "lens" and "file" must be defined.')
+    if params['lens'] and params['file']:
+        command_params['lens'] = params['lens']
+        command_params['file'] = params['file']
+    return [(command, command_params)]
+
+
+def split_batch(batch, tasks, results, changed, diffs=None, root='/'):
+    """Split results of coalesced tasks back into per task results. Task is
+    changed when any of its commands reported modification. Every diff is
+    returned with the first changed task which touches its file (or with the
+    first changed task when files of tasks can't be determined).
+
+    Single `command` tasks get only result of their command, read only tasks
+    are never changed:
+
+    >>> batch = [{'command': 'match'}, {'commands': 'set /files/a/x 1 match /files/a/*'}, {'command': 'set'}]
+    >>> tasks = [[('match', {'path': '/files/a/*'})],
+    ...          [('set', {'path': '/files/a/x', 'value': '1'}), ('match', {'path': '/files/a/*'})],
+    ...          [('set', {'path': '/files/a/y', 'value': '2'})]]
+    >>> results = [('match', []), ('set', True), ('match', [{'label': '/files/a/x', 'value': '1'}]),
+    ...            ('set', False)]
+    >>> assert (split_batch(batch, tasks, results, True) ==
+    ...         [{'changed': False, 'result': []},
+    ...          {'changed': True, 'result': [('set', True), ('match', [{'label': '/files/a/x', 'value': '1'}])]},
+    ...          {'changed': False, 'result': False}])
+    >>> [task['changed'] for task in split_batch(batch, tasks, results, False)]
+    [False, False, False]
+
+    >>> diff = {'before_header': '/tmp/b', 'after_header': '/tmp/b', 'before': '', 'after': 'x'}
+    >>> split_batch([{'command': 'set'}, {'command': 'set'}],
+    ...             [[('set', {'path': 'x', 'value': '1', 'lens': 'Simplevars', 'file': '/tmp/a'})],
+    ...              [('set', {'path': 'x', 'value': '1', 'lens': 'Simplevars', 'file': '/tmp/b'})]],
+    ...             [('set', True), ('set', True)], True, [diff]) == \\
+    ...     [{'changed': True, 'result': True}, {'changed': True, 'result': True, 'diff': [diff]}]
+    True
+    """
+    tasks_results = []
+    for task, task_commands in zip(batch, tasks):
+        task_results, results = results[:len(task_commands)], results[len(task_commands):]
+        task_changed = changed and any(r is True
+                                       for (command, params), (c, r) in zip(task_commands, task_results)
+                                       if command not in READ_ONLY_COMMANDS)
+        if task.get('command') is not None:
+            task_results = task_results[0][1]
+        tasks_results.append({'changed': task_changed, 'result': task_results})
+    changed_tasks = [(task_commands, task_result) for task_commands, task_result in zip(tasks, tasks_results)
+                     if task_result['changed']]
+    for diff in diffs or []:
+        owner = changed_tasks[0][1] if changed_tasks else tasks_results[0]
+        for task_commands, task_result in changed_tasks:
+            files = commands_files(task_commands, root)
+            if files is not None:
+                files.update(p['file'] for c, p in task_commands if 'lens' in p and 'file' in p)
+                if diff['before_header'] in files:
+                    owner = task_result
+                    break
+        owner.setdefault('diff', []).append(diff)
+    return tasks_results
+
+
+def execute_file(args):
+    """Execute commands in separate augeas instance (`files` process pool
+    worker) - returns response dict like `Worker.handle`"""
+    root, loadpath, flags, commands, engine, global_errors, lock_dir, check, diff = args
+    errors = [] if check else None
+    try:
+        with FileLocks(lock_dir or LOCK_DIR, root, commands_locks(commands, root) if lock_dir else set()):
+            augeas_instance = open_augeas(root, loadpath, flags)
+            results, changed = execute(augeas_instance, commands, engine=engine, global_errors=global_errors,
+                                       check=check, errors=errors)
+    except AugeasError as e:
+        return {'failed': True, 'msg': e.msg}
+    except Exception as e:
+        return {'failed': True, 'msg': 'Augeas execution error: %s' % e}
+    if errors:
+        return {'failed': True, 'msg': '\n\n'.join(errors)}
+    response = {'results': results, 'changed': changed}
+    if diff:
+        response['diff'] = saved_diffs(augeas_instance, root)
+    return response
+
+
+def execute_files(root, loadpath, flags, commands, lens, pattern, engine='api', forks=None, global_errors=False,
+                  lock_dir=None, check=False, diff=False):
+    """Execute the same commands (paths are relative to file) against every
+    file matched by glob pattern - every file is handled by its own single
+    file augeas instance in a process pool. Returns tuple (results, changed,
+    errors, diffs)."""
+    files = sorted('/' + os.path.relpath(f, root)
+                   for f in glob.glob(os.path.join(root, pattern.lstrip('/'))) if os.path.isfile(f))
+    partitions = [(root, loadpath, flags,
+                   [(c, dict(p, lens=lens, file=file_) if 'path' in p else dict(p)) for c, p in commands],
+                   engine, global_errors, lock_dir, check, diff)
+                  for file_ in files]
+    if len(partitions) > 1 and forks != 1:
+        pool = multiprocessing.Pool(min(forks or multiprocessing.cpu_count(), len(partitions)))
+        try:
+            responses = pool.map(execute_file, partitions)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        responses = [execute_file(p) for p in partitions]
+    results, changed, errors, diffs = [], False, [], []
+    for file_, response in zip(files, responses):
+        if response.get('failed'):
+            errors.append('%s: %s' % (file_, response['msg']))
+        else:
+            results.extend(response['results'])
+            changed = changed or response['changed']
+            diffs.extend(response.get('diff', []))
+    return results, changed, errors, diffs
+
+
+# commands which results can be cached (see `cache_dir` option)
+CACHEABLE_COMMANDS = ['match', 'defvar', 'export']
+
+
+def file_fingerprint(root, file_):
+    try:
+        stat = os.stat(os.path.join(root, file_.lstrip('/')))
+    except OSError:
+        return None
+    return [stat.st_mtime, stat.st_size, stat.st_ino]
+
+
+# lens directories which are always searched by augeas (besides "loadpath")
+LENS_DIRS = ['/usr/share/augeas/lenses', '/usr/share/augeas/lenses/dist',
+             '/usr/local/share/augeas/lenses', '/usr/local/share/augeas/lenses/dist']
+
+
+def lenses_fingerprint(loadpath):
+    """Return (file, mtime, size) of every lens which can be loaded, so
+    cached results are not used after lenses are upgraded or modified"""
+    directories = (loadpath or '').split(':') + os.environ.get('AUGEAS_LENS_LIB', '').split(':') + LENS_DIRS
+    fingerprint = []
+    for directory in directories:
+        for path in sorted(glob.glob(os.path.join(directory, '*.aug'))):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            fingerprint.append([path, stat.st_mtime, stat.st_size])
+    return fingerprint
+
+
+class MatchCache(object):
+    """On disk cache of read only runs results. Every entry contains
+    fingerprints (mtime, size, inode) of files which contributed to the
+    results and is invalidated when any of them changes. Least recently used
+    entries are evicted when total size exceeds `max_size` bytes.
+
+    >>> root = tempfile.mkdtemp()
+    >>> with open(os.path.join(root, 'hosts'), 'w') as f:
+    ...     _ = f.write('127.0.0.1 localhost\\n')
+    >>> cache = MatchCache(os.path.join(root, 'cache'), 1024)
+    >>> key = cache.key([root, None, 0, [('match', {'path': '/files/hosts/*'})]])
+    >>> cache.get(key, root) is None
+    True
+    >>> cache.put(key, {'/hosts': file_fingerprint(root, '/hosts')}, [['match', []]])
+    >>> cache.get(key, root)
+    [['match', []]]
+
+    Entry is invalidated when mtime or size of the file changes:
+
+    >>> os.utime(os.path.join(root, 'hosts'), (0, 0))
+    >>> cache.get(key, root) is None
+    True
+    >>> cache.put(key, {'/hosts': file_fingerprint(root, '/hosts')}, [['match', []]])
+    >>> with open(os.path.join(root, 'hosts'), 'a') as f:
+    ...     _ = f.write('::1 localhost\\n')
+    >>> cache.get(key, root) is None
+    True
+
+    Least recently used entries are evicted:
+
+    >>> cache = MatchCache(os.path.join(root, 'lru'), 1024)
+    >>> cache.put('a', {}, [])
+    >>> cache.max_size = 2 * os.path.getsize(cache.path('a'))
+    >>> cache.put('b', {}, [])
+    >>> os.utime(cache.path('a'), (1, 1))
+    >>> os.utime(cache.path('b'), (2, 2))
+    >>> cache.get('a', root)
+    []
+    >>> cache.put('c', {}, [])
+    >>> sorted(os.listdir(cache.directory))
+    ['a.json', 'c.json']
+    >>> import shutil
+    >>> shutil.rmtree(root)
+    """
+
+    def __init__(self, directory, max_size):
+        self.directory = os.path.expanduser(directory)
+        self.max_size = max_size
+
+    def key(self, request):
+        return hashlib.sha1(json.dumps(request, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def get(self, key, root):
+        try:
+            with open(self.path(key)) as f:
+                entry = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if any(file_fingerprint(root, f) != fingerprint for f, fingerprint in entry['fingerprints'].items()):
+            return None
+        # modification time is used by LRU eviction
+        os.utime(self.path(key), None)
+        return entry['results']
+
+    def put(self, key, fingerprints, results):
+        """Store results with fingerprints of their files - these have to be
+        taken before files are loaded, otherwise results of old content could
+        be stored with fingerprints of the new one"""
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, 0o700)
+        entry = {'fingerprints': fingerprints, 'results': results}
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entry, f)
+        os.rename(tmp, self.path(key))
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.json'):
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for mtime, size, name in entries)
+        for mtime, size, name in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.unlink(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            total -= size
+
+
+LOCK_DIR = os.path.join('~', '.ansible', 'tmp', 'augeas-locks')
+
+
+def commands_locks(commands, root):
+    """Return files which are going to be modified by commands (empty set
+    for read only commands) or None when any of them can't be resolved (see
+    `commands_files`)
+
+    >>> root = tempfile.mkdtemp()
+    >>> os.mkdir(os.path.join(root, 'etc'))
+    >>> open(os.path.join(root, 'etc', 'hosts'), 'w').close()
+    >>> sorted(commands_locks([('match', {'path': '/files/etc/hosts/*'}),
+    ...                        ('defvar', {'name': 'h', 'expr': '/files/*'})], root))
+    []
+    >>> sorted(commands_locks([('match', {'path': '/files/*/passwd'}),
+    ...                        ('set', {'path': '/files/etc/hosts/1/ipaddr', 'value': '127.0.0.1'})], root))
+    ['/etc/hosts']
+    >>> sorted(commands_locks([('defvar', {'name': 'h', 'expr': '/files/etc/hosts'}),
+    ...                        ('rm', {'path': '$h/1'})], root))
+    ['/etc/hosts']
+    >>> commands_locks([('rm', {'path': '/files/etc/hosts/*[ipaddr="127.0.0.1"]'}),
+    ...                 ('set', {'path': '/files/*/hosts/1/ipaddr', 'value': '127.0.0.1'})], root) is None
+    True
+    >>> sorted(commands_locks([('set', {'path': 'Port', 'value': '22', 'lens': 'sshd', 'file': '/srv/sshd_config'}),
+    ...                        ('rm', {'path': '/files/etc/hosts/2'})], root))
+    ['/etc/hosts', '/srv/sshd_config']
+    >>> import shutil
+    >>> shutil.rmtree(root)
+    """
+    # defvar is kept as variables can be used by modifying commands
+    modifying = [(c, p) for c, p in commands if c not in READ_ONLY_COMMANDS or c == 'defvar']
+    if all(c in READ_ONLY_COMMANDS for c, p in modifying):
+        return set()
+    files = commands_files(modifying, root)
+    if files is not None:
+        files.update(p['file'] for c, p in modifying if 'lens' in p and 'file' in p)
+    return files
+
+
+class FileLocks(object):
+    """Advisory (flock) locks of files which are going to be saved. Lock
+    files are kept in `directory` and named after real paths of locked files,
+    so concurrent invocations against different roots or different files
+    don't block each other.
+
+    Root lock is taken first - shared when files are known and exclusive
+    when they are not (None) - and then files locks are taken exclusively
+    in sorted order. All invocations acquire locks in the same order, so
+    they can't deadlock."""
+
+    def __init__(self, directory, root, files):
+        self.directory = os.path.expanduser(directory)
+        self.root = os.path.realpath(root)
+        self.files = files
+        self.handles = []
+
+    def names(self):
+        """Return (name, shared) of locks in acquisition order
+
+        >>> root = tempfile.mkdtemp()
+        >>> open(os.path.join(root, 'hosts'), 'w').close()
+        >>> os.symlink('hosts', os.path.join(root, 'hosts.link'))
+        >>> names = FileLocks('/tmp', root, set(['/hosts.link', '/hosts', '/resolv.conf'])).names()
+        >>> [(os.path.relpath(name, os.path.realpath(root)), shared) for name, shared in names]
+        [('.', True), ('hosts', False), ('resolv.conf', False)]
+        >>> FileLocks('/tmp', root, None).names() == [(os.path.realpath(root), False)]
+        True
+        >>> FileLocks('/tmp', root, set()).names()
+        []
+        >>> import shutil
+        >>> shutil.rmtree(root)
+        """
+        if self.files is not None and not self.files:
+            return []
+        files = set(os.path.realpath(os.path.join(self.root, f.lstrip('/'))) for f in self.files or [])
+        return [(self.root, self.files is not None)] + [(f, False) for f in sorted(files)]
+
+    def path(self, name):
+        return os.path.join(self.directory, hashlib.sha1(name.encode('utf-8')).hexdigest() + '.lock')
+
+    def lock(self, name, shared):
+        handle = open(self.path(name), 'a')
+        self.handles.append(handle)
+        fcntl.flock(handle.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+
+    def acquire(self):
+        names = self.names()
+        if not names:
+            return
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory, 0o700)
+            except OSError:
+                # created concurrently
+                if not os.path.isdir(self.directory):
+                    raise
+        for name, shared in names:
+            self.lock(name, shared)
+
+    def release(self):
+        while self.handles:
+            handle = self.handles.pop()
+            fcntl.flock(handle.fileno(), fcntl.LOCK_UN)
+            handle.close()
+
+    def __enter__(self):
+        try:
+            self.acquire()
+        except Exception:
+            self.release()
+            raise
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
 def main():
     module = AnsibleModule(
         argument_spec=dict(
             loadpath=dict(default=None),
             root=dict(default=None),
-            command=dict(required=False, choices=['set', 'rm', 'match', 'ins', 'transform', 'load']),
+            command=dict(required=False, choices=['set', 'rm', 'match', 'span', 'ins', 'transform', 'load',
+                                                  'ensure_tree', 'set-if-missing', 'append-unique',
+                                                  'rm-if-value', 'export']),
             path=dict(aliases=['name', 'context']),
             value=dict(default=None),
-            commands=dict(default=None),
+            values=dict(default=None, type='dict'),
+            prune=dict(default='no', type='bool'),
+            limit=dict(default=None, type='int'),
+            offset=dict(default=None, type='int'),
+            count_only=dict(default='no', type='bool'),
+            fields=dict(default=None, type='list'),
+            format=dict(default='rows', choices=['rows', 'columns']),
+            depth=dict(default=None, type='int'),
+            max_nodes=dict(default=None, type='int'),
+            commands=dict(default=None, type='raw'),
             where=dict(default=None),
             label=dict(default=None),
             lens=dict(default=None),
             file=dict(default=None),
-            filter=dict(default=None)
+            files=dict(default=None),
+            forks=dict(default=None, type='int'),
+            filter=dict(default=None),
+            autoload=dict(default='all', choices=['all', 'selective']),
+            engine=dict(default='api', choices=['api', 'srun']),
+            span=dict(default='no', type='bool'),
+            worker=dict(default='no', type='bool'),
+            worker_socket=dict(default=None),
+            worker_timeout=dict(default=300, type='int'),
+            batch=dict(default=None, type='list'),
+            cache_dir=dict(default=None),
+            cache_size=dict(default=10 * 1024 * 1024, type='int'),
+            profile=dict(default='no', type='bool'),
+            profile_dump=dict(default=None),
+            global_errors=dict(default='no', type='bool'),
+            lock=dict(default='no', type='bool'),
+            lock_dir=dict(default=LOCK_DIR)
         ),
         mutually_exclusive=[['commands', 'command'], ['commands', 'value'],
-                            ['commands', 'path']],
+                            ['commands', 'path'], ['batch', 'command'], ['batch', 'commands'],
+                            ['files', 'file'], ['files', 'batch']],
         required_together=[('command', 'path')],
-        required_one_of=[('command', 'commands')],
+        required_one_of=[('command', 'commands', 'batch')],
+        supports_check_mode=True,
     )
     if augeas is None:
         module.fail_json(msg='Could not import python augeas module.'
                              ' Please install augeas related packages and '
                              'augeas python bindings.')
 
-    # Set our flags, indicating if we have span support:
-    flags = getattr(Augeas, 'ENABLE_SPAN', 0)
+    try:
+        if module.params['batch'] is not None:
+            tasks = [build_commands(dict((o, task.get(o)) for o in TASK_OPTIONS))
+                     for task in module.params['batch']]
+            commands = [c for task_commands in tasks for c in task_commands]
+        elif module.params['files'] is not None:
+            if module.params['lens'] is None:
+                raise CommandsParseError('You have to use "lens" argument with "files" argument.')
+            # every file is loaded by its own short living augeas instance
+            if module.params['worker'] or module.params['cache_dir'] or module.params['autoload'] != 'all':
+                raise CommandsParseError('"worker", "cache_dir" and "autoload" arguments can\'t be used with'
+                                         ' "files" argument.')
+            # lens and file are added to commands per matched file
+            commands = build_commands(dict(module.params, lens=None))
+        else:
+            commands = build_commands(module.params)
+    except CommandsParseError as e:
+        module.fail_json(msg=e.msg)
+
+    # Span metadata is kept for every node of every loaded file, so enable
+    # it only when requested (libaugeas versions without span ignore this flag)
+    flags = 0
+    if module.params['span'] or any(command == 'span' for command, params in commands):
+        flags = Augeas.ENABLE_SPAN
     # If we've been given an explicit lens to use, don't bother with the
     # autoload shenanigans.
     # This speeds up module invocation, and because the lens default incl/excl
     # list overrides transform meaning we can't use a specific lens for an
     # existing "known" file.
-    if module.params['lens'] is not None:
+    if module.params['batch'] is not None:
+        lens = all(task.get('lens') for task in module.params['batch'])
+    else:
+        lens = module.params['lens'] is not None
+    if lens:
         flags = flags | getattr(Augeas, 'NO_MODL_AUTOLOAD', 0)
 
-    augeas_instance = Augeas(root=module.params['root'], loadpath=module.params['loadpath'],
-                             flags=flags)
-    commands = None
-    if module.params['command'] is not None:
-        command = module.params['command']
-        if command == 'set':
-            if module.params['value'] is None:
-                module.fail_json(msg='You should use "value" argument with "set" command.')
-            params = {'path': module.params['path'], 'value': module.params['value']}
-        elif command == 'ins':
-            if module.params['label'] is None:
-                module.fail_json(msg='You have to use "label" argument with "ins" command.')
-            if module.params['path'] is None:
-                module.fail_json(msg='You have to use "path" argument with "ins" command.')
-            params = {'label': module.params['label'], 'path': module.params['path'],
-                      'where': module.params['where'] or 'before'}
-        elif command == 'transform':
-            params = {'lens': module.params['lens'], 'file': module.params['file'],
-                      'filter': module.params['filter']}
-        elif command == 'load':
-            params = {}
-        else: # rm or match
-            params = {'path': module.params['path']}
-        if operator.xor(bool(module.params['lens']), bool(module.params['file'])):
-            module.fail_json(msg='Both "lens" and "file" must be defined.')
-        if module.params['lens'] and module.params['file']:
-            params['lens'] = module.params['lens']
-            params['file'] = module.params['file']
-        commands = [(command, params)]
-    else:
+    # Autoload lenses but don't parse anything yet - only files which are
+    # touched by commands are going to be loaded (if we are able to find them).
+    root = module.params['root'] or os.environ.get('AUGEAS_ROOT') or '/'
+    files = None
+    if module.params['autoload'] == 'selective' and not lens:
+        files = commands_files(commands, root)
+
+    lock_dir = module.params['lock_dir'] if module.params['lock'] else None
+    # check mode validates every command in one pass, so "srun" script (which
+    # stops on first failure) is not used; in batch mode every task needs
+    # exact results of its commands (srun reports saves of touched files)
+    engine = 'api' if module.check_mode or module.params['batch'] is not None else module.params['engine']
+    diff = module.check_mode and getattr(module, '_diff', False)
+
+    if module.params['files'] is not None:
+        results, changed, errors, diffs = execute_files(root, module.params['loadpath'], flags, commands,
+                                                        module.params['lens'], module.params['files'],
+                                                        engine, module.params['forks'],
+                                                        module.params['global_errors'], lock_dir,
+                                                        module.check_mode, diff)
+        if errors:
+            module.fail_json(msg='\n\n'.join(errors), result=results)
+        if diff:
+            module.exit_json(changed=changed, result=results, diff=diffs)
+        module.exit_json(changed=changed, result=results)
+
+    results = None
+    cache = None
+    if module.params['cache_dir'] is not None and all(c in CACHEABLE_COMMANDS for c, p in commands):
+        cache_files = commands_files(commands, root)
+        if cache_files is not None:
+            cache_files.update(p['file'] for c, p in commands if 'lens' in p and 'file' in p)
+            cache = MatchCache(module.params['cache_dir'], module.params['cache_size'])
+            cache_key = cache.key([root, module.params['loadpath'], flags, commands,
+                                   lenses_fingerprint(module.params['loadpath'])])
+            cache_fingerprints = dict((f, file_fingerprint(root, f)) for f in cache_files)
+            results = cache.get(cache_key, root)
+            changed = False
+    # worker keeps trees between runs, so it can't be used for changes which are never saved
+    version = module_version() if module.params['worker'] else None
+    if results is None and version is not None and not module.check_mode:
+        response = worker_execute(module.params['worker_socket'] or WORKER_SOCKET,
+                                  module.params['worker_timeout'],
+                                  {'root': root, 'loadpath': module.params['loadpath'],
+                                   'flags': flags, 'files': sorted(files) if files is not None else None,
+                                   'commands': commands, 'engine': engine,
+                                   'global_errors': module.params['global_errors'], 'lock_dir': lock_dir,
+                                   'version': version, 'lenses': lenses_fingerprint(module.params['loadpath'])})
+        # fallback to local execution when worker is not available
+        if response is not None:
+            if response.get('failed'):
+                module.fail_json(msg=response['msg'])
+            results, changed = response['results'], response['changed']
+            if cache is not None:
+                cache.put(cache_key, cache_fingerprints, results)
+    # additional results (timings, diff)
+    extra = {}
+    if results is None:
+        timings = {} if module.params['profile'] else None
+        if module.params['profile_dump']:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        augeas_instance = None
+        errors = [] if module.check_mode else None
         try:
-            commands = parse_commands(module.params['commands'])
-        except CommandsParseError as e:
-            module.fail_json(msg=e.msg)
-    try:
-        results, changed = execute(augeas_instance, commands)
-    except AugeasError as e:
-        module.fail_json(msg=e.msg)
-
+            # files are loaded under locks, so changes saved concurrently aren't overwritten
+            with FileLocks(module.params['lock_dir'], root,
+                           commands_locks(commands, root) if lock_dir else set()):
+                augeas_instance = open_augeas(module.params['root'], module.params['loadpath'], flags, files,
+                                              timings)
+                results, changed = execute(augeas_instance, commands, engine=engine, timings=timings,
+                                           global_errors=module.params['global_errors'],
+                                           check=module.check_mode, errors=errors)
+        except AugeasError as e:
+            if timings is not None:
+                timings['errors'] = e.errors_time
+                extra['timings'] = profile_summary(augeas_instance, timings)
+            module.fail_json(msg=e.msg, **extra)
+        finally:
+            if module.params['profile_dump']:
+                profiler.disable()
+                profiler.dump_stats(module.params['profile_dump'])
+        if timings is not None:
+            extra['timings'] = profile_summary(augeas_instance, timings)
+        # all failing commands are reported at once in check mode
+        if errors:
+            module.fail_json(msg='\n\n'.join(errors), result=results, **extra)
+        if diff:
+            extra['diff'] = saved_diffs(augeas_instance, root)
+        if cache is not None:
+            cache.put(cache_key, cache_fingerprints, results)
+
+    if module.params['batch'] is not None:
+        batch = split_batch(module.params['batch'], tasks, results, changed, extra.pop('diff', None), root)
+        module.exit_json(changed=changed, batch=batch, **extra)
     # in case of single command execution return only one result
     # in case of multpile commands return list of (command, result) tuples
     if module.params['command'] is not None:
         results = results[0][1]
-    module.exit_json(changed=changed, result=results)
+    module.exit_json(changed=changed, result=results, **extra)
 
 
 # this is magic, see lib/ansible/module_common.py
 #<<INCLUDE_ANSIBLE_MODULE_COMMON>>
 
-main()
+# module can be imported (e.g. by benchmarks) without execution
+if __name__ == '__main__':
+    main()